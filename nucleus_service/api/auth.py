@@ -1,11 +1,176 @@
+import copy
+import hashlib
+import hmac
+import os
+import threading
 import time
 import traceback
+import uuid
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from rest_framework_httpsignature.authentication import SignatureAuthentication
 from rest_framework import exceptions
+from rest_framework.authentication import BasicAuthentication
+
+from api.models import NucleusUser
+from api.nonces import get_nonce_store
+
+
+AUTH_VERSION_KEY = 'auth_version:%s'
+
+
+def auth_version(user_id):
+    """ Return the version of the authentication data of a user kept in the
+        default Django cache. It changes with every change to the user, its
+        projects or its API key, made by any process sharing the cache.
+    """
+    keys = (AUTH_VERSION_KEY % 'all', AUTH_VERSION_KEY % user_id)
+    versions = cache.get_many(keys)
+    if len(versions) < len(keys):
+        # A version never set or evicted gets a new random one, so it does
+        # not match the entries cached with the version it had before
+        for key in keys:
+            if key not in versions:
+                cache.add(key, uuid.uuid4().hex, None)
+        versions = cache.get_many(keys)
+        if len(versions) < len(keys):
+            return None
+    return tuple(versions[key] for key in keys)
+
+
+def change_auth_version(user_id=None):
+    """Change the version of a user, or of all the users if None."""
+    key = AUTH_VERSION_KEY % ('all' if user_id is None else user_id)
+    cache.set(key, uuid.uuid4().hex, None)
+
+
+class TTLCache(object):
+    """ Process-local cache whose entries live for settings.AUTH_CACHE_TTL
+        seconds. Each entry belongs to a user and is only returned while
+        the auth_version() of the user is the one it was stored with, a
+        cache lookup instead of the queries or the password hashing.
+
+        The signals below change the versions, so with a shared cache
+        (e.g. memcached) a change is seen at once by all the processes.
+        With the per process default of settings.CACHES, the other
+        processes see it when the entries expire. Changes that bypass the
+        signals, like QuerySet.update(), are always seen then.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        (expires, user_id, version, value) = entry
+        # Without a version (the cache failed) nothing is trusted
+        if version is None or auth_version(user_id) != version:
+            return None
+        return value
+
+    def set(self, key, user_id, version, value):
+        """ Store the value of key for the user with its auth_version(),
+            read as soon as the user is known so that a change made while
+            the value is loaded is not hidden.
+        """
+        with self._lock:
+            self._entries[key] = (time.time() + settings.AUTH_CACHE_TTL,
+                                  user_id, version, value)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+# API key -> (user, secret, project ids)
+api_keys = TTLCache()
+
+# User id -> project ids
+user_projects = TTLCache()
+
+# Keyed hash of a username and password -> user, for the credentials that
+# passed the password check
+verified_credentials = TTLCache()
+
+
+def project_ids(user):
+    """ Return the frozenset of the ids of the projects (groups) of the
+        user making the request, so permission checks are set lookups.
+        It is computed once per request, and cached across requests.
+    """
+    ids = getattr(user, 'project_ids', None)
+    if ids is None:
+        ids = user_projects.get(user.pk)
+        if ids is None:
+            version = auth_version(user.pk)
+            ids = frozenset(user.groups.values_list('id', flat=True))
+            user_projects.set(user.pk, user.pk, version, ids)
+        user.project_ids = ids
+    return ids
+
+
+@receiver(post_save, sender=NucleusUser)
+@receiver(post_delete, sender=NucleusUser)
+def invalidate_api_key(sender, instance, **kwargs):
+    api_keys.invalidate(instance.key_name)
+    change_auth_version(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_users(sender, instance, **kwargs):
+    # A password change or deactivation is a User save
+    if isinstance(instance, User):
+        change_auth_version(instance.pk)
+    elif kwargs.get('pk_set'):
+        # The members added to or removed from a project
+        for user_id in kwargs['pk_set']:
+            change_auth_version(user_id)
+    else:
+        # A project cleared of its members
+        change_auth_version()
+    api_keys.invalidate()
+    user_projects.invalidate()
+    verified_credentials.invalidate()
+
+
+class NucleusBasicAuthentication(BasicAuthentication):
+    """ BasicAuthentication that runs the password hasher only once per
+        AUTH_CACHE_TTL for the credentials of a scripted client.
+
+        Verified credentials are remembered under an HMAC of the username
+        and password with a random key of the process, so neither the
+        password nor a hash that can be attacked offline is kept. A
+        password change or deactivation changes the auth_version() of the
+        user, so with a shared cache the old credentials are refused at
+        once by every process, otherwise for up to AUTH_CACHE_TTL.
+    """
+    CREDENTIALS_KEY = os.urandom(32)
+
+    def authenticate_credentials(self, userid, password, *args):
+        credentials = (u'%s\0%s' % (userid, password)).encode('utf-8')
+        key = hmac.new(self.CREDENTIALS_KEY, credentials,
+                       hashlib.sha256).digest()
+        user = verified_credentials.get(key)
+        if user is not None:
+            return (copy.copy(user), None)
+
+        parent = super(NucleusBasicAuthentication, self)
+        (user, auth) = parent.authenticate_credentials(userid, password, *args)
+        verified_credentials.set(key, user.pk, auth_version(user.pk),
+                                 copy.copy(user))
+        return (user, auth)
 
-from api.models import Nonce
 
 class NucleusAPISignatureAuthentication(SignatureAuthentication):
     # The HTTP header used to pass the consumer key ID.
@@ -16,11 +181,22 @@ class NucleusAPISignatureAuthentication(SignatureAuthentication):
     # A method to fetch (User instance, user_secret_string) from the
     # consumer key ID, or None in case it is not found.
     def fetch_user_data(self, api_key):
-        try:
-            user = User.objects.get(api_key=api_key)
-            return (user, user.api_key.secret)
-        except User.DoesNotExist:
-            return None
+        data = api_keys.get(api_key)
+        if data is None:
+            try:
+                key = NucleusUser.objects.select_related('user').get(
+                    key_name=api_key)
+            except NucleusUser.DoesNotExist:
+                return None
+            version = auth_version(key.user_id)
+            data = (key.user, key.secret, project_ids(key.user))
+            api_keys.set(api_key, key.user_id, version, data)
+
+        # Every request gets its own copy of the cached user
+        (user, secret, ids) = data
+        user = copy.copy(user)
+        user.project_ids = ids
+        return (user, secret)
 
     def authenticate(self, request):
 
@@ -37,16 +213,20 @@ class NucleusAPISignatureAuthentication(SignatureAuthentication):
         if not ts:
             raise exceptions.AuthenticationFailed('No timestamp provided')
 
-        ts_diff = int(time.time()) - int(ts)
+        try:
+            ts = int(ts)
+        except ValueError:
+            raise exceptions.AuthenticationFailed('Invalid timestamp')
+
+        ts_diff = int(time.time()) - ts
 
         if abs(ts_diff) > self.TIME_BACK:
             raise exceptions.AuthenticationFailed(
-                'Timestamp is more than %s minutes different from the server.' % TIME_BACK)
+                'Timestamp is more than %s minutes different from the server.'
+                % (self.TIME_BACK // 60))
 
-        try:
-            nonce = Nonce(nonce=nonce, timestamp=ts)
-            nonce.save(force_insert=True)
-        except:
+        # Nonces are only kept for TIME_BACK, older requests fail above
+        if not get_nonce_store(self.TIME_BACK).add(nonce, ts):
             raise exceptions.AuthenticationFailed('Nonce check failed')
 
         return SignatureAuthentication.authenticate(self, request)
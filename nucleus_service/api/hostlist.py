@@ -31,13 +31,18 @@ expressions.
 The hostlist expression syntax is the same as in several programs
 developed at LLNL (https://computing.llnl.gov/linux/). However in
 corner cases the behaviour of this module have not been compared for
-compatibility with pdsh/dshbak/SLURM et al.
+compatibility with pdsh/dshbak/SLURM et al. HostlistRegressionTest in
+api/tests.py records the current behaviour on the node list shapes
+nucleus sees.
 """
 
 __version__ = "1.13"
 
 import re
 import itertools
+import bisect
+import threading
+from collections import OrderedDict
 
 # Exception used for error reporting to the caller
 class BadHostlist(Exception): pass
@@ -45,7 +50,25 @@ class BadHostlist(Exception): pass
 # Configuration to guard against ridiculously long expanded lists
 MAX_SIZE = 100000
 
+# Number of expressions and host lists the memoized functions remember,
+# and the number of hosts they may hold in total. A larger result is not
+# cached, so a few huge node lists cannot take the memory of the process.
+CACHE_SIZE = 256
+CACHE_MAX_HOSTS = 65536
+
 # Hostlist expansion
+#
+# The grammar is precompiled and expanded without recursion. A hostlist is
+# split at its top level commas, each part is split into prefix[rangelist]
+# groups and the groups are combined right to left in a loop. The errors are
+# raised in the same order as the original recursive expander did:
+# bracket errors as they are scanned, the groups of a part from right to
+# left, and the size of a part checked after each of its groups.
+
+_special_re = re.compile(r'[][,]')
+_group_re = re.compile(r'\[([^]]*)\]')
+_number_re = re.compile(r'^[0-9]+$')
+_range_re = re.compile(r'^([0-9]+)-([0-9]+)$')
 
 def expand_hostlist(hostlist, allow_duplicates=False, sort=False):
     """Expand a hostlist expression string to a Python list.
@@ -58,28 +81,8 @@ def expand_hostlist(hostlist, allow_duplicates=False, sort=False):
     """
 
     results = []
-    bracket_level = 0
-    part = ""
-    
-    for c in hostlist + ",":
-        if c == "," and bracket_level == 0:
-            # Comma at top level, split!
-            if part: results.extend(expand_part(part))
-            part = ""
-            bad_part = False
-        else:
-            part += c
-
-        if c == "[": bracket_level += 1
-        elif c == "]": bracket_level -= 1
-
-        if bracket_level > 1:
-            raise BadHostlist, "nested brackets"
-        elif bracket_level < 0:
-            raise BadHostlist, "unbalanced brackets"
-
-    if bracket_level > 0:
-        raise BadHostlist, "unbalanced brackets"
+    for part in _split_hostlist(hostlist):
+        results.extend(expand_part(part))
 
     if not allow_duplicates:
         results = remove_duplicates(results)
@@ -87,78 +90,154 @@ def expand_hostlist(hostlist, allow_duplicates=False, sort=False):
         results = numerically_sorted(results)
     return results
 
-def expand_part(s):
-    """Expand a part (e.g. "x[1-2]y[1-3][1-3]") (no outer level commas)."""
+def iter_hostlist(hostlist, allow_duplicates=False):
+    """Expand a hostlist expression string lazily, one host at a time.
 
-    # Base case: the empty part expand to the singleton list of ""
-    if s == "":
-        return [""]
+    The hosts are generated in the order of expand_hostlist(), one
+    comma separated part at a time. A bad hostlist raises BadHostlist
+    once the generator reaches the error.
+    """
 
-    # Split into:
-    # 1) prefix string (may be empty)
-    # 2) rangelist in brackets (may be missing)
-    # 3) the rest
+    seen = set()
+    for part in _split_hostlist(hostlist):
+        for host in expand_part(part):
+            if allow_duplicates:
+                yield host
+            elif host not in seen:
+                seen.add(host)
+                yield host
 
-    m = re.match(r'([^,\[]*)(\[[^\]]*\])?(.*)', s)
-    (prefix, rangelist, rest) = m.group(1,2,3)
+def _split_hostlist(hostlist):
+    """Generate the non-empty top level parts of a hostlist."""
 
-    # Expand the rest first (here is where we recurse!)
-    rest_expanded = expand_part(rest)
+    bracket_level = 0
+    start = 0
+
+    for m in _special_re.finditer(hostlist + ","):
+        c = m.group()
+        if c == ",":
+            if bracket_level == 0:
+                # Comma at top level, split!
+                part = hostlist[start:m.start()]
+                start = m.end()
+                if part:
+                    yield part
+        elif c == "[":
+            bracket_level += 1
+            if bracket_level > 1:
+                raise BadHostlist, "nested brackets"
+        else:
+            bracket_level -= 1
+            if bracket_level < 0:
+                raise BadHostlist, "unbalanced brackets"
 
-    # Expand our own part
-    if not rangelist:
-        # If there is no rangelist, our own contribution is the prefix only
-        us_expanded = [prefix]
-    else:
-        # Otherwise expand the rangelist (adding the prefix before)
-        us_expanded = expand_rangelist(prefix, rangelist[1:-1])
+    if bracket_level > 0:
+        raise BadHostlist, "unbalanced brackets"
 
-    # Combine our list with the list from the expansion of the rest
-    # (but guard against too large results first)
-    if len(us_expanded) * len(rest_expanded) > MAX_SIZE:
-        raise BadHostlist, "results too large"
+def expand_part(s):
+    """Expand a part (e.g. "x[1-2]y[1-3][1-3]") (no outer level commas)."""
 
-    return [us_part + rest_part
-            for us_part in us_expanded
-            for rest_part in rest_expanded]
+    (groups, suffix) = _parse_part(s)
+    return _combine(groups, suffix)
 
-def expand_rangelist(prefix, rangelist):
-    """ Expand a rangelist (e.g. "1-10,14"), putting a prefix before."""
-    
-    # Split at commas and expand each range separately
-    results = []
-    for range_ in rangelist.split(","):
-        results.extend(expand_range(prefix, range_))
+def _combine(groups, suffix):
+    """Expand parsed (prefix, ranges) groups followed by a suffix."""
+
+    results = [suffix]
+    for prefix, ranges in reversed(groups):
+        hosts = _expand_ranges(prefix, ranges)
+        if results == [""]:
+            results = hosts
+        else:
+            results = [host + rest for host in hosts for rest in results]
     return results
 
-def expand_range(prefix, range_):
-    """ Expand a range (e.g. 1-10 or 14), putting a prefix before."""
+def _parse_part(s):
+    """Parse a part into a list of (prefix, ranges) groups and a suffix.
 
-    # Check for a single number first
-    m = re.match(r'^[0-9]+$', range_)
-    if m:
-        return ["%s%s" % (prefix, range_)]
+    The groups are checked right to left, each one before the size of
+    the result with the groups on its right.
+    """
 
-    # Otherwise split low-high
-    m = re.match(r'^([0-9]+)-([0-9]+)$', range_)
+    m = _group_re.search(s)
+    if not m:
+        return ([], s)
+
+    # Like the original expander, ignore what follows a newline after
+    # the first group
+    newline = s.find("\n", m.end())
+    if newline >= 0:
+        s = s[:newline]
+
+    # [prefix, rangelist, prefix, rangelist, ..., suffix]
+    pieces = _group_re.split(s)
+    if "[" in pieces[-1]:
+        # The newline cut a group short, which sent the original
+        # expander into infinite recursion
+        raise BadHostlist, "unbalanced brackets"
+
+    groups = []
+    size = 1
+    for i in xrange(len(pieces) - 2, 0, -2):
+        ranges = [_parse_range(range_) for range_ in pieces[i].split(",")]
+        group_size = 0
+        for low, high, width in ranges:
+            group_size += 1 if low is None else high - low + 1
+        if group_size * size > MAX_SIZE:
+            raise BadHostlist, "results too large"
+        size *= group_size
+        groups.append((pieces[i - 1], ranges))
+    groups.reverse()
+    return (groups, pieces[-1])
+
+def _parse_range(range_):
+    """Parse a range into (low, high, width), or (None, range_, None)
+    for a single number, which is used verbatim."""
+
+    if _number_re.match(range_):
+        return (None, range_, None)
+
+    m = _range_re.match(range_)
     if not m:
         raise BadHostlist, "bad range"
 
     (s_low, s_high) = m.group(1,2)
     low = int(s_low)
     high = int(s_high)
-    width = len(s_low)
 
     if high < low:
         raise BadHostlist, "start > stop"
     elif high - low > MAX_SIZE:
         raise BadHostlist, "range too large"
+    return (low, high, len(s_low))
+
+def _expand_ranges(prefix, ranges):
+    """Format parsed ranges as a list of hosts, putting a prefix before."""
 
     results = []
-    for i in xrange(low, high+1):
-        results.append("%s%0*d" % (prefix, width, i))
+    for low, high, width in ranges:
+        if low is None:
+            results.append("%s%s" % (prefix, high))
+        elif len(str(low)) >= width:
+            # No padding needed
+            results.extend([prefix + num for num in
+                            itertools.imap(str, xrange(low, high+1))])
+        else:
+            fmt = prefix.replace("%", "%%") + "%%0%dd" % width
+            results.extend([fmt % i for i in xrange(low, high+1)])
     return results
 
+def expand_rangelist(prefix, rangelist):
+    """ Expand a rangelist (e.g. "1-10,14"), putting a prefix before."""
+
+    return _expand_ranges(prefix, [_parse_range(range_)
+                                   for range_ in rangelist.split(",")])
+
+def expand_range(prefix, range_):
+    """ Expand a range (e.g. 1-10 or 14), putting a prefix before."""
+
+    return _expand_ranges(prefix, [_parse_range(range_)])
+
 def remove_duplicates(l):
     """Remove duplicates from a list (but keep the order)."""
     seen = set()
@@ -170,6 +249,14 @@ def remove_duplicates(l):
     return results
 
 # Hostlist collection
+#
+# Every host is parsed once into its prefix, rightmost number and suffix
+# and the hosts that only differ in the number are grouped. Each group is
+# sorted once and merged into ranges, and collapses into a single entry
+# whose prefix is parsed again the same way, until no numbers are left.
+
+_host_re = re.compile(r'(?:((?:.*[^0-9])?)([0-9]+))?([^0-9]*)\Z', re.DOTALL)
+_forbidden_re = re.compile(r'[][,]')
 
 def collect_hostlist(hosts, silently_discard_bad = False):
     """Collect a hostlist string from a Python list of hosts.
@@ -181,156 +268,449 @@ def collect_hostlist(hosts, silently_discard_bad = False):
     is true causing the bad hostname to be silently discarded instead).
     """
 
-    # Split hostlist into a list of (host, "") for the iterative part.
-    # (Also check for bad node names now)
-    # The idea is to move already collected numerical parts from the
-    # left side (seen by each loop) to the right side (just copied).
-
-    left_right = []
-    for host in hosts:
-        # We remove leading and trailing whitespace first, and skip empty lines
-        host = host.strip()
-        if host == "": continue
-
-        # We cannot accept a host containing any of the three special
-        # characters in the hostlist syntax (comma and flat brackets)
-        if re.search(r'[][,]', host):
-            if silently_discard_bad:
-                continue
+    # We remove leading and trailing whitespace first, and skip empty lines
+    unique = set([host.strip() for host in hosts])
+    unique.discard("")
+
+    # We cannot accept a host containing any of the three special
+    # characters in the hostlist syntax (comma and flat brackets)
+    if _forbidden_re.search("".join(unique)):
+        if not silently_discard_bad:
+            raise BadHostlist, "forbidden character"
+        unique = [host for host in unique if not _forbidden_re.search(host)]
+
+    # Entries are (left, right): the left part is analyzed, while the
+    # right part holds the range expressions already collected
+    results = set()
+    entries = [(host, "") for host in unique]
+    while entries:
+        groups = {}
+        for left, right in entries:
+            (prefix, num_str, suffix) = _host_re.match(left).groups()
+            if num_str is None:
+                # No numeric part left, the entry is done
+                results.add(left + right)
             else:
-                raise BadHostlist, "forbidden character"
+                groups.setdefault((prefix, suffix + right), []).append(num_str)
 
-        left_right.append((host, ""))
+        entries = [(prefix, collect_numbers(num_strs) + suffix)
+                   for (prefix, suffix), num_strs in groups.iteritems()]
 
-    # Call the iterative function until it says it's done
-    looping = True
-    while looping:
-        left_right, looping = collect_hostlist_1(left_right)
-    return ",".join([left + right for left, right in left_right])
+    return ",".join(sorted(results))
 
-def collect_hostlist_1(left_right):
-    """Collect a hostlist string from a list of hosts (left+right).
+def collect_numbers(num_strs):
+    """Collect distinct number strings into a range expression.
 
-    The input is a list of tuples (left, right). The left part
-    is analyzed, while the right part is just passed along
-    (it can contain already collected range expressions).
+    E.g. collect_numbers(["1", "2", "3", "5"]) ==> "[1-3,5]" and
+    collect_numbers(["08", "09", "10"]) ==> "[08-10]", but
+    collect_numbers(["7"]) ==> "7".
     """
 
-    # Scan the list of hosts (left+right) and build two things:
-    # *) a set of all hosts seen (used later)
-    # *) a list where each host entry is preprocessed for correct sorting
-
-    sortlist = []
-    remaining = set()
-    for left, right in left_right:
-        host = left + right
-        remaining.add(host)
-
-        # Match the left part into parts
-        m = re.match(r'^(.*?)([0-9]+)?([^0-9]*)$', left)
-        (prefix, num_str, suffix) = m.group(1,2,3)
-
-        # Add the right part unprocessed to the suffix.
-        # This ensures than an already computed range expression
-        # in the right part is not analyzed again.
-        suffix = suffix + right 
-
-        if num_str is None:
-            # A left part with no numeric part at all gets special treatment!
-            # The regexp matches with the whole string as the suffix,
-            # with nothing in the prefix or numeric parts.
-            # We do not want that, so we move it to the prefix and put
-            # None as a special marker where the suffix should be.
-            assert prefix == ""
-            sortlist.append(((host, None), None, None, host))
+    range_list = []
+    widths = set(map(len, num_strs))
+    if len(widths) == 1 or not [num_str for num_str in num_strs
+                                if num_str[0] == "0" and len(num_str) > 1]:
+        # All of the same width, or no zero padding: the ranges are the
+        # runs of consecutive numbers, with the common width or else the
+        # natural width of their first number
+        width = len(widths) == 1 and widths.pop()
+        nums = sorted(map(int, num_strs))
+        low = prev = nums[0]
+        for num_int in nums:
+            if num_int > prev + 1:
+                range_list.append((low, prev, width or len(str(low))))
+                low = num_int
+            prev = num_int
+        range_list.append((low, prev, width or len(str(low))))
+    else:
+        # A range continues while the next number formatted with the
+        # width of its first one is found, and like "%0*d" that width
+        # grows with the number past the padding
+        remaining = set([(int(num_str), len(num_str)) for num_str in num_strs])
+        for num_int, num_width in sorted(remaining):
+            if (num_int, num_width) not in remaining:
+                # Already covered by a range below
+                continue
+            low = num_int
+            width = num_width
+            limit = 10 ** width
+            while (num_int, width) in remaining:
+                remaining.remove((num_int, width))
+                num_int += 1
+                if num_int == limit:
+                    width += 1
+                    limit *= 10
+            range_list.append((low, num_int - 1, num_width))
+
+    if len(range_list) == 1 and range_list[0][0] == range_list[0][1]:
+        # Special case to make sure that n1 is not shown as n[1] etc
+        return "%0*d" % (range_list[0][2], range_list[0][0])
+    return "[" + ",".join([format_range(l, h, w)
+                           for l, h, w in range_list]) + "]"
+
+def format_range(low, high, width):
+    """Format a range from low to high inclusively, with a certain width."""
+
+    if low == high:
+        return "%0*d" % (width, low)
+    else:
+        return "%0*d-%0*d" % (width, low, width, high)
+
+# Compressed host sets
+#
+# A HostSet keeps the hosts with a number as sorted intervals of numbers
+# per (prefix, suffix, width) key, where the number is the rightmost one
+# of the host. A number with leading zeroes has the width of its digits
+# and any other number width 0, so that every host has exactly one key:
+# the zero padded range 08-10 is stored as 08-09 of width 2 and 10 of
+# width 0. Hosts without a number are kept as they are.
+
+_digit_re = re.compile(r'[0-9]')
+
+def _host_key(host):
+    """Return the (prefix, suffix, width) key and the number of a host,
+    or (None, None) for a host without a number."""
+
+    (prefix, num_str, suffix) = _host_re.match(host).group(1,2,3)
+    if num_str is None:
+        return (None, None)
+    if len(num_str) > 1 and num_str[0] == "0":
+        return ((prefix, suffix, len(num_str)), int(num_str))
+    return ((prefix, suffix, 0), int(num_str))
+
+def _normalize(intervals):
+    """Sort intervals, merging the overlapping and adjacent ones."""
+
+    results = []
+    for low, high in sorted(intervals):
+        if results and low <= results[-1][1] + 1:
+            if high > results[-1][1]:
+                results[-1] = (results[-1][0], high)
         else:
-            # A left part with at least an numeric part
-            # (we care about the rightmost numeric part)
-            num_int = int(num_str)
-            num_width = len(num_str) # This width includes leading zeroes
-            sortlist.append(((prefix, suffix), num_int, num_width, host))
+            results.append((low, high))
+    return results
 
-    # Sort lexicographically, first on prefix, then on suffix, then on
-    # num_int (numerically), then...
-    # This determines the order of the final result.
+def _intersect(a, b):
+    """Intersect two normalized interval lists."""
 
-    sortlist.sort()
+    results = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        low = max(a[i][0], b[j][0])
+        high = min(a[i][1], b[j][1])
+        if low <= high:
+            results.append((low, high))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return results
 
-    # We are ready to collect the result parts as a list of new (left,
-    # right) tuples.
+def _subtract(a, b):
+    """Subtract normalized interval list b from a."""
 
     results = []
-    needs_another_loop = False 
+    j = 0
+    for low, high in a:
+        while j < len(b) and b[j][1] < low:
+            j += 1
+        k = j
+        while k < len(b) and b[k][0] <= high:
+            if b[k][0] > low:
+                results.append((low, b[k][0] - 1))
+            low = max(low, b[k][1] + 1)
+            k += 1
+        if low <= high:
+            results.append((low, high))
+    return results
 
-    # Now group entries with the same prefix+suffix combination (the
-    # key is the first element in the sortlist) to loop over them and
-    # then to loop over the list of hosts sharing the same
-    # prefix+suffix combination.
+class HostSet(object):
+    """An immutable set of hosts stored as ranges.
 
-    for ((prefix, suffix), group) in itertools.groupby(sortlist,
-                                                       key=lambda x:x[0]):
+    Example: HostSet.from_hostlist("n[1-100000]") & HostSet(["n5", "m1"])
+             ==> HostSet('n5')
 
-        if suffix is None:
-            # Special case: a host with no numeric part
-            results.append(("", prefix)) # Move everything to the right part
-            remaining.remove(prefix)
+    Membership, length and the set operations work on the ranges,
+    without expanding them to the hosts.
+    """
+
+    def __init__(self, hosts=()):
+        intervals = {}
+        names = set()
+        for host in hosts:
+            self._add(intervals, names, host)
+        self._set(dict((key, _normalize(values))
+                       for key, values in intervals.items()), names)
+
+    @staticmethod
+    def _add(intervals, names, host):
+        if host == "":
+            return
+        if _forbidden_re.search(host):
+            raise BadHostlist, "forbidden character"
+        (key, num) = _host_key(host)
+        if key is None:
+            names.add(host)
         else:
-            # The general case. We prepare to collect a list of
-            # ranges expressed as (low, high, width) for later
-            # formatting.
-            range_list = []
-    
-            for ((prefix2, suffix2), num_int, num_width, host) in group:
-                if host not in remaining:
-                    # Below, we will loop internally to enumate a whole range
-                    # at a time. We then remove the covered hosts from the set.
-                    # Therefore, skip the host here if it is gone from the set.
+            intervals.setdefault(key, []).append((num, num))
+
+    def _set(self, ranges, names):
+        self._ranges = ranges
+        self._names = frozenset(names)
+        self._len = len(self._names) + sum(
+            high - low + 1
+            for intervals in ranges.values() for low, high in intervals)
+        return self
+
+    @classmethod
+    def _new(cls, ranges, names):
+        return cls.__new__(cls)._set(
+            dict((key, intervals) for key, intervals in ranges.items()
+                 if intervals), names)
+
+    @classmethod
+    def from_hostlist(cls, hostlist):
+        """Create a HostSet from a hostlist expression string.
+
+        The hostlist is checked like expand_hostlist() does, but the
+        ranges are only expanded when their hosts have another number
+        to the right of the range.
+        """
+
+        intervals = {}
+        names = set()
+        for part in _split_hostlist(hostlist):
+            (groups, suffix) = _parse_part(part)
+            if not groups:
+                cls._add(intervals, names, suffix)
+                continue
+
+            (prefix, ranges) = groups[-1]
+            for left in _combine(groups[:-1], prefix):
+                if (_digit_re.search(suffix) or
+                    (left and _digit_re.match(left[-1]))):
+                    # The range is not the rightmost number of the hosts
+                    for host in _expand_ranges(left, ranges):
+                        cls._add(intervals, names, host + suffix)
                     continue
-                assert num_int is not None
 
-                # Scan for a range starting at the current host
-                low = num_int
-                while True:
-                    host = "%s%0*d%s" % (prefix, num_width, num_int, suffix)
-                    if host in remaining:
-                        remaining.remove(host)
-                        num_int += 1
-                    else:
-                        break
-                high = num_int - 1
-                assert high >= low
-                range_list.append((low, high, num_width))
-
-            # We have a list of ranges to format. We make sure
-            # we move our handled numerical part to the right to
-            # stop it from being processed again.
-            needs_another_loop = True
-            if len(range_list) == 1 and range_list[0][0] == range_list[0][1]:
-                # Special case to make sure that n1 is not shown as n[1] etc
-                results.append((prefix,
-                                "%0*d%s" % 
-                               (range_list[0][2], range_list[0][0], suffix)))
+                for low, high, width in ranges:
+                    if low is None:
+                        cls._add(intervals, names, left + high + suffix)
+                        continue
+                    if width > 1 and low < 10 ** (width - 1):
+                        split = 10 ** (width - 1)
+                        intervals.setdefault((left, suffix, width), []).append(
+                            (low, min(high, split - 1)))
+                        low = split
+                    if low <= high:
+                        intervals.setdefault((left, suffix, 0), []).append(
+                            (low, high))
+
+        return cls._new(dict((key, _normalize(values))
+                             for key, values in intervals.items()), names)
+
+    def to_hostlist(self):
+        """Return a hostlist expression string of the hosts."""
+
+        parts = []
+        for (prefix, suffix, width), intervals in self._sorted_ranges():
+            if "\n" in suffix:
+                # The expander ignores what follows a newline after a
+                # group, so these hosts cannot be collected
+                parts.extend(self._iter_key(prefix, suffix, width, intervals))
+            elif len(intervals) == 1 and intervals[0][0] == intervals[0][1]:
+                parts.append("%s%0*d%s" % (prefix, width, intervals[0][0], suffix))
             else:
-                # General case where high > low
-                results.append((prefix, "[" + \
-                                   ",".join([format_range(l, h, w)
-                                             for l, h, w in range_list]) + \
-                                   "]" + suffix))
-
-    # At this point, the set of remaining hosts should be empty and we
-    # are ready to return the result, together with the flag that says
-    # if we need to loop again (we do if we have added something to a
-    # left part).
-    assert not remaining
-    return results, needs_another_loop
-
-def format_range(low, high, width):
-    """Format a range from low to high inclusively, with a certain width."""
-
-    if low == high:
-        return "%0*d" % (width, low)
-    else:
-        return "%0*d-%0*d" % (width, low, width, high)
+                parts.append("%s[%s]%s" % (prefix, ",".join(
+                    [format_range(low, high, width) for low, high in intervals]),
+                    suffix))
+        parts.extend(sorted(self._names))
+        return ",".join(parts)
+
+    def _sorted_ranges(self):
+        # The zero padded hosts sort before the unpadded ones
+        return sorted(self._ranges.items(),
+                      key=lambda item: (item[0][0], item[0][1], -item[0][2]))
+
+    @staticmethod
+    def _iter_key(prefix, suffix, width, intervals):
+        for low, high in intervals:
+            for num in xrange(low, high + 1):
+                yield "%s%0*d%s" % (prefix, width, num, suffix)
+
+    def __iter__(self):
+        for (prefix, suffix, width), intervals in self._sorted_ranges():
+            for host in self._iter_key(prefix, suffix, width, intervals):
+                yield host
+        for host in sorted(self._names):
+            yield host
+
+    def __len__(self):
+        return self._len
+
+    def __nonzero__(self):
+        return self._len > 0
+
+    def __contains__(self, host):
+        if not isinstance(host, basestring) or _forbidden_re.search(host):
+            return False
+        (key, num) = _host_key(host)
+        if key is None:
+            return host in self._names
+        intervals = self._ranges.get(key, ())
+        i = bisect.bisect_right(intervals, (num, float("inf"))) - 1
+        return i >= 0 and intervals[i][0] <= num <= intervals[i][1]
+
+    def __eq__(self, other):
+        if not isinstance(other, HostSet):
+            return NotImplemented
+        return self._ranges == other._ranges and self._names == other._names
+
+    def __ne__(self, other):
+        if not isinstance(other, HostSet):
+            return NotImplemented
+        return not self == other
+
+    def __hash__(self):
+        return hash((frozenset((key, tuple(intervals))
+                               for key, intervals in self._ranges.items()),
+                     self._names))
+
+    def __repr__(self):
+        return "HostSet(%r)" % self.to_hostlist()
+
+    __str__ = to_hostlist
+
+    def union(self, other):
+        other = _host_set(other)
+        ranges = dict(self._ranges)
+        for key, intervals in other._ranges.items():
+            ranges[key] = _normalize(ranges.get(key, []) + intervals)
+        return self._new(ranges, self._names | other._names)
+
+    def intersection(self, other):
+        other = _host_set(other)
+        return self._new(
+            dict((key, _intersect(intervals, other._ranges[key]))
+                 for key, intervals in self._ranges.items()
+                 if key in other._ranges),
+            self._names & other._names)
+
+    def difference(self, other):
+        other = _host_set(other)
+        return self._new(
+            dict((key, _subtract(intervals, other._ranges.get(key, [])))
+                 for key, intervals in self._ranges.items()),
+            self._names - other._names)
+
+    def isdisjoint(self, other):
+        return not self.intersection(other)
+
+    def issubset(self, other):
+        return not self.difference(other)
+
+    def _operator(method):
+        def operator(self, other):
+            if not isinstance(other, HostSet):
+                return NotImplemented
+            return method(self, other)
+        return operator
+
+    __or__ = _operator(union)
+    __and__ = _operator(intersection)
+    __sub__ = _operator(difference)
+    __le__ = _operator(issubset)
+    del _operator
+
+def _host_set(hosts):
+    """Return hosts as a HostSet, parsing a hostlist string."""
+
+    if isinstance(hosts, HostSet):
+        return hosts
+    if isinstance(hosts, basestring):
+        return HostSet.from_hostlist(hosts)
+    return HostSet(hosts)
+
+# Memoized expansion
+#
+# Every state change message of a job carries its node list again, so the
+# expansions are kept in a bounded LRU cache keyed by the exact input and
+# returned as tuples that cannot be modified by the caller. Errors are not
+# cached. The cache is per process and counts its hits and misses.
+#
+# Only use it for the node lists Slurm hands out, not for the input of API
+# requests.
+
+class LRUCache(object):
+    """A thread safe mapping of at most maxsize entries weighing at most
+    maxweight in total, evicting the least recently used ones. An entry
+    heavier than maxweight on its own is not cached."""
+
+    def __init__(self, maxsize, maxweight, weigh):
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.hits = 0
+        self.misses = 0
+        self.weight = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """Return the value of key, calling compute() to fill it in."""
+
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                return value
+            self.misses += 1
+
+        value = compute()
+        weight = self.weigh(key, value)
+        if weight > self.maxweight:
+            return value
+        with self._lock:
+            if key in self._entries:
+                # Filled in by another thread meanwhile
+                self.weight -= self.weigh(key, self._entries.pop(key))
+            self._entries[key] = value
+            self.weight += weight
+            while (len(self._entries) > self.maxsize or
+                   self.weight > self.maxweight):
+                (old_key, old_value) = self._entries.popitem(last=False)
+                self.weight -= self.weigh(old_key, old_value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._entries), "maxsize": self.maxsize,
+                    "hosts": self.weight, "maxhosts": self.maxweight}
+
+_expand_cache = LRUCache(CACHE_SIZE, CACHE_MAX_HOSTS,
+                         lambda key, hosts: len(hosts))
+
+def cached_expand_hostlist(hostlist, allow_duplicates=False, sort=False):
+    """Like expand_hostlist, but memoized and returning a tuple."""
+
+    return _expand_cache.get(
+        (hostlist, allow_duplicates, sort),
+        lambda: tuple(expand_hostlist(hostlist, allow_duplicates, sort)))
+
+def cache_info():
+    """Return the counters of the expansion cache."""
+
+    return _expand_cache.info()
 
 # Sort a list of hosts numerically
 
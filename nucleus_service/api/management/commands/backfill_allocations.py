@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import ComputeAllocation, ComputeSet
+
+
+class Command(BaseCommand):
+    help = ("Create the missing ComputeAllocation rows of the computes held "
+            "by the computesets that were live before the table existed.")
+
+    def handle(self, *args, **options):
+        # The computesets the old membership check treated as holding
+        # their computes, less the ones update_computeset now releases
+        live = ComputeSet.objects.exclude(
+            state=ComputeSet.CSET_STATE_COMPLETED).exclude(
+            state=ComputeSet.CSET_STATE_FAILED, jobid__isnull=True)
+        membership = ComputeSet.computes.through.objects.filter(
+            computeset__in=live, compute__allocation__isnull=True)
+
+        with transaction.atomic():
+            held = {}
+            # A compute in several live computesets goes to the latest one
+            for computeset_id, compute_id in membership.order_by(
+                    'computeset_id').values_list('computeset_id', 'compute_id'):
+                held[compute_id] = computeset_id
+            ComputeAllocation.objects.bulk_create([
+                ComputeAllocation(computeset_id=computeset_id,
+                                  compute_id=compute_id)
+                for compute_id, computeset_id in held.items()])
+
+        self.stdout.write("Allocated %d computes" % len(held))
@@ -101,7 +101,7 @@ class NucleusUser(models.Model):
 
 class Nonce(models.Model):
     nonce = models.CharField(max_length=128, primary_key=True)
-    timestamp = models.IntegerField()
+    timestamp = models.IntegerField(db_index=True)
 
     class Meta:
         managed = True
@@ -144,6 +144,56 @@ class ComputeSet(models.Model):
     class Meta:
         managed = True
 
+# #################################################
+#  COMPUTE ALLOCATION
+# #################################################
+
+
+class ComputeAllocation(models.Model):
+    """A compute currently held by a ComputeSet.
+
+    There is at most one row per compute: it is claimed when the ComputeSet
+    is created and released when the ComputeSet completes, or fails before
+    its job was submitted, so checking whether a compute is free is a single
+    unique index lookup.
+    """
+    compute = models.OneToOneField(Compute, related_name='allocation')
+    computeset = models.ForeignKey(ComputeSet, related_name='allocations')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        managed = True
+
+# #################################################
+#  STATE EVENT
+# #################################################
+
+
+class StateEvent(models.Model):
+    """A committed state change of a computeset or a compute.
+
+    The auto-incremented id is the sequence number event stream clients
+    resume from. The computeset events are also the append-only transition
+    log of the metrics, so only the compute events are ever purged.
+    """
+    EVENT_KIND_COMPUTESET = 'computeset'
+    EVENT_KIND_COMPUTE = 'compute'
+    EVENT_KINDS = (
+        (EVENT_KIND_COMPUTESET, 'ComputeSet'),
+        (EVENT_KIND_COMPUTE, 'Compute'),
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    kind = models.CharField(max_length=16, choices=EVENT_KINDS)
+    cluster = models.ForeignKey(Cluster, related_name='events')
+    object_id = models.PositiveIntegerField()
+    name = models.CharField(max_length=128, null=True)
+    old_state = models.CharField(max_length=128, null=True)
+    state = models.CharField(max_length=128, null=True)
+
+    class Meta:
+        managed = True
+        index_together = (('kind', 'created'),)
+
 # #################################################
 #  Network
 # #################################################
@@ -0,0 +1,111 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# #################################################
+#  NONCE STORES
+# #################################################
+#
+# A signed request is accepted while its timestamp is within window seconds
+# of the server time, so its nonce only has to be remembered until then.
+# Nonces are kept in buckets of window seconds by their timestamp, and the
+# bucket b can be forgotten as a whole once the time reaches (b + 2) * window.
+
+
+class NonceStore(object):
+    """Remembers the nonces of the signed requests that are still valid."""
+
+    def __init__(self, window):
+        self.window = window
+
+    def add(self, nonce, timestamp):
+        """Record a nonce, returning False if it was already used."""
+        raise NotImplementedError
+
+    def bucket(self, timestamp):
+        return int(timestamp) // self.window
+
+    def expires(self, bucket):
+        """Return the time the nonces of a bucket can be forgotten."""
+        return (bucket + 2) * self.window
+
+
+class MemoryNonceStore(NonceStore):
+    """Keeps the nonces in the memory of the API process.
+
+    Only suitable when the API runs in a single process, a replay reaching
+    another process is not detected.
+    """
+
+    def __init__(self, window):
+        super(MemoryNonceStore, self).__init__(window)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def add(self, nonce, timestamp):
+        now = time.time()
+        with self._lock:
+            for bucket in [bucket for bucket in self._buckets
+                           if self.expires(bucket) <= now]:
+                del self._buckets[bucket]
+            for nonces in self._buckets.values():
+                if nonce in nonces:
+                    return False
+            self._buckets.setdefault(self.bucket(timestamp), set()).add(nonce)
+        return True
+
+
+class CacheNonceStore(NonceStore):
+    """Keeps the nonces in the default Django cache until their bucket
+    expires. With a shared cache like memcached, whose add() is atomic,
+    replays are detected across all the API processes.
+    """
+
+    KEY_PREFIX = 'nonce:'
+
+    def add(self, nonce, timestamp):
+        from django.core.cache import cache
+        timeout = self.expires(self.bucket(timestamp)) - int(time.time())
+        if timeout <= 0:
+            return False
+        key = self.KEY_PREFIX + hashlib.sha1(nonce).hexdigest()
+        return cache.add(key, 1, timeout)
+
+
+class DatabaseNonceStore(NonceStore):
+    """Keeps the nonces in the Nonce table. The expired ones are deleted in
+    batches by the periodic api.tasks.purge_nonces task, off the request path.
+    """
+
+    def add(self, nonce, timestamp):
+        from django.db import DataError, IntegrityError, transaction
+        from api.models import Nonce
+        try:
+            with transaction.atomic():
+                Nonce.objects.create(nonce=nonce, timestamp=int(timestamp))
+        except (IntegrityError, DataError):
+            # A nonce used before, or one too long to be stored
+            return False
+        return True
+
+    def expired(self):
+        """Return the queryset of the nonces that can be forgotten."""
+        from api.models import Nonce
+        # The buckets up to current - 2 have expired
+        current = self.bucket(time.time())
+        return Nonce.objects.filter(timestamp__lt=(current - 1) * self.window)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_nonce_store(window):
+    """Return the settings.NONCE_STORE instance for a window."""
+    with _stores_lock:
+        if window not in _stores:
+            _stores[window] = import_string(settings.NONCE_STORE)(window)
+        return _stores[window]
@@ -0,0 +1,32 @@
+import zlib
+
+# Not django.conf, the tasks are also sent from the Django-free comet-fe1
+# worker and scripts, like nucleus/celery.py configures celery
+from nucleus import settings
+
+
+class UpdatePartitionRouter(object):
+    """ Route the update tasks to one of the update.<n> queues.
+
+        The messages of a computeset, or of a cluster, always hash to the
+        same partition, and each partition is consumed by a single worker
+        process, so they are processed in order while the partitions are
+        processed in parallel.
+    """
+
+    def route_for_task(self, task, args=None, kwargs=None):
+        if task == 'api.tasks.update_computeset':
+            key = args[0].get('id')
+        elif task == 'api.tasks.update_clusters':
+            # update_status.py sends one cluster per message
+            key = args[0][0]['frontend'] if args[0] else ''
+        else:
+            return None
+        return {'queue': update_queue(key)}
+
+
+def update_queue(key):
+    """Return the update queue of a partition key."""
+    partition = ((zlib.crc32('%s' % key) & 0xffffffff) %
+                 settings.UPDATE_QUEUE_PARTITIONS)
+    return 'update.%d' % partition
@@ -3,6 +3,7 @@ import django.contrib.auth.models
 from rest_framework import serializers
 
 from models import Cluster, Frontend, FrontendInterface, Compute, ComputeInterface, ComputeSet
+from models import StateEvent
 
 # #################################################
 #  USER
@@ -70,6 +71,12 @@ class ComputeSetSerializer(serializers.ModelSerializer):
     computes = ComputeSerializer(many=True, read_only=True)
     cluster = serializers.SlugRelatedField(read_only=True, slug_field='name')
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Load the related rows rendered here in a fixed number of queries."""
+        return queryset.select_related('cluster').prefetch_related(
+            'computes__interface', 'computes__cluster')
+
     class Meta:
         model = ComputeSet
         fields = ['computes', 'id', 'state', 'cluster']
@@ -80,6 +87,8 @@ class FullComputeSetSerializer(serializers.ModelSerializer):
     computes = ComputeSerializer(many=True, read_only=True)
     cluster = serializers.SlugRelatedField(read_only=True, slug_field='name')
 
+    setup_eager_loading = ComputeSetSerializer.setup_eager_loading
+
     class Meta:
         model = ComputeSet
         fields = ['computes', 'id', 'state', 'cluster', 'user', 'account',
@@ -96,8 +105,25 @@ class ClusterSerializer(serializers.ModelSerializer):
     project = serializers.SlugRelatedField(read_only=True, slug_field='name')
     allocations = serializers.SlugRelatedField(read_only=True, slug_field='allocation', many='True')
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """Load the related rows rendered here in a fixed number of queries."""
+        return queryset.select_related('frontend', 'project').prefetch_related(
+            'frontend__interface', 'computes__interface', 'allocations')
+
     class Meta:
         model = Cluster
         fields = ('name', 'description', 'computes',
                   'frontend', 'project', 'vlan', 'allocations')
         read_only_fields = ('computes', 'name', 'frontend', 'vlan', 'allocations')
+
+
+class StateEventSerializer(serializers.ModelSerializer):
+    cluster = serializers.SlugRelatedField(read_only=True, slug_field='name')
+
+    class Meta:
+        model = StateEvent
+        fields = ('id', 'created', 'kind', 'cluster', 'object_id', 'name',
+                  'old_state', 'state')
+        read_only_fields = ('id', 'created', 'kind', 'cluster', 'object_id',
+                            'name', 'old_state', 'state')
@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from subprocess import Popen, PIPE, check_output, STDOUT, CalledProcessError
 import traceback
 import syslog
+import time
 
 from celery import shared_task
 syslog.openlog('nucleus-service', syslog.LOG_PID, syslog.LOG_USER)
@@ -120,91 +121,276 @@ def cancel_computeset(cset):
 
 
 @shared_task(ignore_result=True)
-def update_computeset(cset_json):
-    """ This task runs on comet-nucleus and can update the database """
-    from api.models import ComputeSet
-    from api import hostlist
-    syslog.syslog(syslog.LOG_DEBUG, "update_computeset() running")
+def cancel_computesets(csets):
+    """ Cancel several computeset jobs with a single scancel call.
+        See cancel_computeset() for how the jobs react to the signal.
+    """
+    syslog.syslog(syslog.LOG_DEBUG, "cancel_computesets() running")
+
+    cmd = ['/usr/bin/timeout',
+           '10',
+           '/usr/bin/scancel',
+           '--batch',
+           '--quiet',
+           '--signal=USR1']
+    cmd.extend(['%s' % (cset['jobid']) for cset in csets])
 
     try:
-        cset = ComputeSet.objects.get(id=cset_json['id'])
-
-        cset.jobid = cset_json["jobid"]
-
-        if "name" in cset_json:
-            cset.name = cset_json["name"]
-
-        if "user" in cset_json:
-            cset.user = cset_json["user"]
-
-        if "account" in cset_json:
-            cset.account = cset_json["account"]
-
-        if "walltime_mins" in cset_json:
-            cset.walltime_mins = cset_json["walltime_mins"]
-
-        if "node_count" in cset_json:
-            cset.node_count = cset_json["node_count"]
-
-        cset.save()
-
-        # The following will only exist after jobscript barrier...
-        if "nodelist" in cset_json:
-            cset.nodelist = cset_json["nodelist"]
-            cset.save()
-
-        old_cset_state = None
-        if "state" in cset_json:
-            old_cset_state = cset.state
-            if cset.state != cset_json["state"]:
-                cset.state = cset_json["state"]
-                cset.save()
-
-            # Job passed from SUBMITTED to RUNNING state...
-            if (old_cset_state == ComputeSet.CSET_STATE_SUBMITTED
-                and cset.state == ComputeSet.CSET_STATE_RUNNING):
-                if cset.nodelist is not None:
-                    cset = ComputeSet.objects.get(pk=cset.id)
-                    nodes = []
-                    for compute in cset.computes.all():
-                        nodes.append(compute.rocks_name)
-
-                    hosts = hostlist.expand_hostlist("%s" % cset.nodelist)
-                    # TODO: vlan & switchport configuration
-                    poweron_nodeset.delay(nodes, hosts, None)
-
-            # Job passed from SUBMITTED to COMPLETED state directly...
-            if (old_cset_state == ComputeSet.CSET_STATE_SUBMITTED
-                and cset.state == ComputeSet.CSET_STATE_COMPLETED):
-                if cset.nodelist is not None:
-                    hosts = hostlist.expand_hostlist("%s" % cset.nodelist)
-                    # TODO: anything else todo?
-
-            # Job passed from RUNNING to ENDING state...
-            if (old_cset_state == ComputeSet.CSET_STATE_RUNNING
-                and cset.state == ComputeSet.CSET_STATE_ENDING):
-                if cset.nodelist is not None:
-                    nodes = []
-                    for compute in cset.computes.all():
-                        nodes.append(compute.rocks_name)
-
-                    poweroff_nodes.delay(nodes, "shutdown")
-                    # TODO: vlan & switchport de-configuration
-
-            # Job passed from RUNNING to CANCELLED state...
-            if (old_cset_state == ComputeSet.CSET_STATE_RUNNING
-                and cset.state == ComputeSet.CSET_STATE_CANCELLED):
-                if cset.nodelist is not None:
-                    nodes = [compute.rocks_name for compute in cset.computes.all()]
-                    poweroff_nodes.delay(nodes, "shutdown")
-                    # TODO: vlan & switchport de-configuration
-
-    except ComputeSet.DoesNotExist:
-        cset = None
-        msg = "update_computeset: %s" % (
-            "ComputeSet (%d) does not exist" % (cset_json["id"]))
+        check_output(cmd, stderr=STDOUT)
+        state = "cancelled"
+        syslog.syslog(syslog.LOG_INFO, "Cancelling computeset jobs %s" % (
+            ", ".join(["%s" % (cset['name']) for cset in csets])))
+
+    except OSError as e:
+        state = "failed"
+        msg = "OSError: %s" % (e)
         syslog.syslog(syslog.LOG_ERR, msg)
 
+    except CalledProcessError as e:
+        state = "failed"
+        if e.returncode == 124:
+            msg = "CalledProcessError: Timeout during request: %s" % (
+                e.output.strip().rstrip())
+        else:
+            msg = "CalledProcessError: %s" % (e.output.strip().rstrip())
+        syslog.syslog(syslog.LOG_ERR, msg)
+
+    for cset in csets:
+        cset["state"] = state
+        update_computeset.delay(cset)
+
+
+# Actions run by update_computeset() in the transaction of a state
+# transition. They return the (task, args) messages to send once it is
+# committed, so a slow broker does not hold the transaction open.
+
+
+# Seconds between the reports of the hostlist cache counters of a worker
+# process to syslog, to size hostlist.CACHE_SIZE and CACHE_MAX_HOSTS
+HOSTLIST_CACHE_REPORT_INTERVAL = 60 * 60
+
+_hostlist_cache_reported = time.time()
+
+
+def _expand_nodelist(nodelist):
+    """ Expand the node list of a job through the hostlist cache, as
+        every state change message of the job carries it again. Returns
+        None if Slurm sent an invalid one.
+    """
+    global _hostlist_cache_reported
+    from api import hostlist
+    try:
+        hosts = hostlist.cached_expand_hostlist("%s" % nodelist)
+    except hostlist.BadHostlist as e:
+        syslog.syslog(syslog.LOG_ERR, "Bad nodelist %s: %s" % (nodelist, e))
+        return None
+
+    if time.time() - _hostlist_cache_reported >= \
+            HOSTLIST_CACHE_REPORT_INTERVAL:
+        _hostlist_cache_reported = time.time()
+        syslog.syslog(syslog.LOG_INFO, "hostlist cache: %s" % (
+            hostlist.cache_info()))
+    return hosts
+
+
+def _poweron_computeset(cset):
+    """Power on the computes on the physical hosts Slurm allocated."""
+    # The nodelist will only exist after jobscript barrier...
+    if cset.nodelist is not None:
+        hosts = _expand_nodelist(cset.nodelist)
+        if hosts is None:
+            return []
+        nodes = list(cset.computes.values_list('rocks_name', flat=True))
+        # TODO: vlan & switchport configuration
+        return [(poweron_nodeset, (nodes, list(hosts), None))]
+    return []
+
+
+def _poweroff_computeset(cset):
+    """Shut down the computes of a job that is ending or was cancelled."""
+    if cset.nodelist is not None:
+        nodes = list(cset.computes.values_list('rocks_name', flat=True))
+        # TODO: vlan & switchport de-configuration
+        return [(poweroff_nodes, (nodes, "shutdown"))]
+    return []
+
+
+def _release_computeset(cset):
+    """Release the computes held by a job that reached its terminal state."""
+    from api.models import ComputeAllocation
+    ComputeAllocation.objects.filter(computeset=cset).delete()
+    return []
+
+
+def _release_failed_computeset(cset):
+    """Release the computes of a ComputeSet that failed before its job was
+    submitted, as no job can still hold them."""
+    if cset.jobid is None:
+        return _release_computeset(cset)
+    return []
+
+# Allowed ComputeSet state transitions and the actions to run for each.
+# A message asking for any other transition (e.g. a late "submitted" after
+# the job already reported "running") only updates the other fields.
+CSET_TRANSITIONS = {
+    ("created", "submitted"): (),
+    ("created", "running"): (_poweron_computeset,),
+    ("created", "cancelled"): (),
+    ("created", "failed"): (_release_failed_computeset,),
+    ("created", "completed"): (_release_computeset,),
+    ("submitted", "running"): (_poweron_computeset,),
+    ("submitted", "cancelled"): (),
+    ("submitted", "ending"): (),
+    ("submitted", "failed"): (_release_failed_computeset,),
+    ("submitted", "completed"): (_release_computeset,),
+    ("running", "cancelled"): (_poweroff_computeset,),
+    ("running", "ending"): (_poweroff_computeset,),
+    ("running", "failed"): (_release_failed_computeset,),
+    ("running", "completed"): (_release_computeset,),
+    ("cancelled", "running"): (),
+    ("cancelled", "ending"): (),
+    ("cancelled", "failed"): (_release_failed_computeset,),
+    ("cancelled", "completed"): (_release_computeset,),
+    ("ending", "failed"): (_release_failed_computeset,),
+    ("ending", "completed"): (_release_computeset,),
+    ("failed", "running"): (_poweron_computeset,),
+    ("failed", "ending"): (),
+    ("failed", "completed"): (_release_computeset,),
+}
+
+# ComputeSet fields a message may carry besides the state
+CSET_UPDATE_FIELDS = ("jobid", "name", "user", "account", "walltime_mins",
+                      "node_count", "nodelist")
+
+# Attempts before giving up on a ComputeSet that keeps changing under us
+CSET_UPDATE_RETRIES = 5
+
+
+@shared_task(ignore_result=True)
+def update_computeset(cset_json):
+    """ This task runs on comet-nucleus and can update the database.
+
+        Only the fields that differ are written, with a single
+        UPDATE ... WHERE state=<old state>. If another worker changed the
+        state in between, the ComputeSet is re-read and the message is
+        applied again, so several workers can consume the update queue.
+    """
+    from django.db import transaction
+    from api.models import ComputeSet, StateEvent
+    syslog.syslog(syslog.LOG_DEBUG, "update_computeset() running")
+
+    if cset_json.get("nodelist") and \
+            _expand_nodelist(cset_json["nodelist"]) is None:
+        # Keep the other changes, without a nodelist poweron cannot use
+        cset_json = dict(cset_json)
+        del cset_json["nodelist"]
+
+    for attempt in range(CSET_UPDATE_RETRIES):
+        try:
+            cset = ComputeSet.objects.get(id=cset_json['id'])
+        except ComputeSet.DoesNotExist:
+            msg = "update_computeset: %s" % (
+                "ComputeSet (%d) does not exist" % (cset_json["id"]))
+            syslog.syslog(syslog.LOG_ERR, msg)
+            return
+
+        changes = {}
+        for field in CSET_UPDATE_FIELDS:
+            if field in cset_json:
+                value = ComputeSet._meta.get_field(field).to_python(
+                    cset_json[field])
+                if getattr(cset, field) != value:
+                    changes[field] = value
+
+        actions = ()
+        state = cset_json.get("state")
+        if state and state != cset.state:
+            if (cset.state, state) in CSET_TRANSITIONS:
+                changes["state"] = state
+                actions = CSET_TRANSITIONS[(cset.state, state)]
+            else:
+                msg = "update_computeset: ignoring ComputeSet (%d) %s -> %s" % (
+                    cset.id, cset.state, state)
+                syslog.syslog(syslog.LOG_WARNING, msg)
+
+        if not changes:
+            return
+
+        messages = []
+        with transaction.atomic():
+            updated = ComputeSet.objects.filter(
+                pk=cset.pk, state=cset.state).update(**changes)
+            if updated:
+                if "state" in changes:
+                    StateEvent.objects.create(
+                        kind=StateEvent.EVENT_KIND_COMPUTESET,
+                        cluster_id=cset.cluster_id, object_id=cset.id,
+                        name=changes.get("name", cset.name),
+                        old_state=cset.state, state=changes["state"])
+                for field, value in changes.items():
+                    setattr(cset, field, value)
+                for action in actions:
+                    messages.extend(action(cset))
+        if updated:
+            for (task, args) in messages:
+                task.delay(*args)
+            return
+
+    msg = "update_computeset: ComputeSet (%d) kept changing, giving up" % (
+        cset_json["id"])
+    syslog.syslog(syslog.LOG_ERR, msg)
+
+
+# Rows deleted per statement by the purge tasks, so that a large backlog
+# does not hold locks for long
+PURGE_BATCH_SIZE = 1000
+
+
+def _purge(queryset):
+    """Delete the rows of queryset in batches, returning their number."""
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('pk', flat=True)[:PURGE_BATCH_SIZE])
+        if not ids:
+            return deleted
+        queryset.model.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
+
+
+@shared_task(ignore_result=True)
+def purge_state_events():
+    """ Delete the compute state events older than
+        settings.STATE_EVENT_RETENTION. The computeset events are kept as
+        the transition log of the metrics.
+    """
+    import datetime
+    from django.conf import settings
+    from django.utils import timezone
+    from api.models import StateEvent
+    syslog.syslog(syslog.LOG_DEBUG, "purge_state_events() running")
+
+    cutoff = timezone.now() - datetime.timedelta(
+        seconds=settings.STATE_EVENT_RETENTION)
+    deleted = _purge(StateEvent.objects.filter(
+        kind=StateEvent.EVENT_KIND_COMPUTE, created__lt=cutoff))
+    if deleted:
+        syslog.syslog(syslog.LOG_INFO,
+                      "purge_state_events: deleted %d events" % deleted)
+
+
+@shared_task(ignore_result=True)
+def purge_nonces():
+    """Delete the nonces of the signed requests too old to be replayed."""
+    from api.auth import NucleusAPISignatureAuthentication
+    from api.nonces import DatabaseNonceStore
+    syslog.syslog(syslog.LOG_DEBUG, "purge_nonces() running")
+
+    store = DatabaseNonceStore(NucleusAPISignatureAuthentication.TIME_BACK)
+    deleted = _purge(store.expired())
+    if deleted:
+        syslog.syslog(syslog.LOG_INFO,
+                      "purge_nonces: deleted %d nonces" % deleted)
+
 
 @shared_task(ignore_result=True)
 def poweron_nodeset(nodes, hosts, iso_name):
@@ -302,27 +488,90 @@ def _poweron_nodes(nodes):
 
 @shared_task(ignore_result=True)
 def update_clusters(clusters_json):
-    from api.models import Cluster, Frontend, Compute, ComputeSet, FrontendInterface, ComputeInterface
+    """ Sync the clusters reported by update_status.py into the database.
+
+        The frontends, clusters, computes and interfaces of all the reported
+        clusters are loaded with a handful of queries and compared in memory,
+        so only the rows that differ are written and a sync without changes
+        costs almost nothing. The clusters that fail to sync are reported
+        back to update_status.py.
+    """
+    from api.models import Cluster, Frontend, Compute, FrontendInterface, ComputeInterface
     syslog.syslog(syslog.LOG_DEBUG, "update_clusters() running")
+
+    frontends = dict(
+        (frontend.rocks_name, frontend) for frontend in Frontend.objects.filter(
+            rocks_name__in=[cluster_rocks["frontend"] for cluster_rocks in clusters_json]))
+    clusters = dict(
+        (cluster.frontend_id, cluster) for cluster in Cluster.objects.filter(
+            frontend__in=frontends.values()))
+    computes = dict(
+        (compute.rocks_name, compute) for compute in Compute.objects.filter(
+            cluster__in=clusters.values()))
+    frontend_interfaces = _load_interfaces(
+        FrontendInterface, "frontend",
+        FrontendInterface.objects.filter(frontend__in=frontends.values()),
+        [interface["mac"] for cluster_rocks in clusters_json
+         for interface in cluster_rocks["interfaces"]])
+    compute_interfaces = _load_interfaces(
+        ComputeInterface, "compute",
+        ComputeInterface.objects.filter(compute__cluster__in=clusters.values()),
+        [interface["mac"] for cluster_rocks in clusters_json
+         for compute_rocks in cluster_rocks["computes"]
+         for interface in compute_rocks["interfaces"]])
+
+    changed_states = []
+    failed = []
     for cluster_rocks in clusters_json:
         try:
-            cluster_obj = Cluster.objects.get(
-                frontend__rocks_name=cluster_rocks["frontend"])
-
-            if cluster_obj.vlan != cluster_rocks["vlan"]:
-                cluster_obj.vlan = cluster_rocks["vlan"]
-                cluster_obj.save()
-
-            frontend = Frontend.objects.get(
-                rocks_name=cluster_rocks["frontend"])
-            if(frontend.state != cluster_rocks["state"]
-                or frontend.memory != cluster_rocks["mem"]
-                or frontend.cpus != cluster_rocks["cpus"]):
-                frontend.state = cluster_rocks["state"]
-                frontend.memory = cluster_rocks["mem"]
-                frontend.cpus = cluster_rocks["cpus"]
-                frontend.save()
-        except Cluster.DoesNotExist:
+            changed_states.extend(_sync_cluster(
+                cluster_rocks, frontends, clusters, computes,
+                frontend_interfaces, compute_interfaces))
+        except:
+            print traceback.format_exc()
+            failed.append(cluster_rocks["frontend"])
+
+    if failed:
+        try:
+            _report_sync_failures(failed)
+        except:
+            print traceback.format_exc()
+
+    try:
+        _cancel_idle_computesets(changed_states)
+    except:
+        print traceback.format_exc()
+
+
+# Queue update_status.py reads the frontends whose sync failed from, to
+# publish them again on its next sweep even if they did not change
+SYNC_FAILURES_QUEUE = 'update_status.failed'
+
+
+def _report_sync_failures(frontends):
+    """Tell update_status.py the frontends whose sync failed."""
+    from celery import current_app
+    with current_app.connection() as connection:
+        queue = connection.SimpleQueue(SYNC_FAILURES_QUEUE)
+        try:
+            queue.put({'frontends': frontends}, serializer='json')
+        finally:
+            queue.close()
+
+
+def _sync_cluster(cluster_rocks, frontends, clusters, computes,
+                  frontend_interfaces, compute_interfaces):
+    """ Apply the differences between one reported cluster and the rows
+        loaded by update_clusters() in a single transaction.
+        Returns the ids of the computes whose state changed.
+    """
+    from django.db import transaction
+    from api.models import Cluster, Frontend, Compute, FrontendInterface, ComputeInterface
+    from api.models import StateEvent
+
+    with transaction.atomic():
+        frontend = frontends.get(cluster_rocks["frontend"])
+        if frontend is None:
             frontend = Frontend()
             frontend.name = cluster_rocks["frontend"]
             frontend.rocks_name = cluster_rocks["frontend"]
@@ -331,51 +580,179 @@ def update_clusters(clusters_json):
             frontend.cpus = cluster_rocks["cpus"]
             frontend.type = cluster_rocks["type"]
             frontend.save()
-
+        elif(frontend.state != cluster_rocks["state"]
+             or frontend.memory != _clean(Frontend, "memory", cluster_rocks["mem"])
+             or frontend.cpus != _clean(Frontend, "cpus", cluster_rocks["cpus"])):
+            Frontend.objects.filter(pk=frontend.pk).update(
+                state=cluster_rocks["state"], memory=cluster_rocks["mem"],
+                cpus=cluster_rocks["cpus"])
+
+        cluster_obj = clusters.get(frontend.pk)
+        if cluster_obj is None:
             cluster_obj = Cluster()
             cluster_obj.name = cluster_rocks["frontend"]
             cluster_obj.vlan = cluster_rocks["vlan"]
             cluster_obj.frontend = frontend
             cluster_obj.save()
+        elif cluster_obj.vlan != _clean(Cluster, "vlan", cluster_rocks["vlan"]):
+            Cluster.objects.filter(pk=cluster_obj.pk).update(
+                vlan=cluster_rocks["vlan"])
 
-        cluster_obj = Cluster.objects.get(
-            frontend__rocks_name=cluster_rocks["frontend"])
-        frontend = Frontend.objects.get(rocks_name=cluster_rocks["frontend"])
-        for interface in cluster_rocks['interfaces']:
-            if interface["mac"]:
-                if_obj, created = FrontendInterface.objects.update_or_create(
-                    frontend=frontend, ip=interface["ip"], netmask=interface["netmask"],
-                    mac=interface["mac"], iface=interface["iface"], subnet=interface["subnet"])
+        _sync_interfaces(FrontendInterface, "frontend", frontend_interfaces,
+                         [(frontend.pk, cluster_rocks["interfaces"])])
 
+        new_computes = []
+        changed_computes = {}
+        events = []
         for compute_rocks in cluster_rocks["computes"]:
-            compute_obj, created = Compute.objects.get_or_create(
-                rocks_name=compute_rocks["name"], cluster=cluster_obj)
-            if created:
-                compute_obj.name = compute_rocks["name"]
-                compute_obj.state = compute_rocks["state"]
-                compute_obj.memory = compute_rocks["mem"]
-                compute_obj.cpus = compute_rocks["cpus"]
-                compute_obj.type = compute_rocks["type"]
-                compute_obj.save()
+            compute_obj = computes.get(compute_rocks["name"])
+            if compute_obj is None:
+                new_computes.append(Compute(
+                    name=compute_rocks["name"], rocks_name=compute_rocks["name"],
+                    cluster=cluster_obj, state=compute_rocks["state"],
+                    memory=compute_rocks["mem"], cpus=compute_rocks["cpus"],
+                    type=compute_rocks["type"]))
             elif(compute_obj.state != compute_rocks["state"]
-                or compute_obj.memory != compute_rocks["mem"]
-                or compute_obj.cpus != compute_rocks["cpus"]):
-                compute_obj.state = compute_rocks["state"]
-                compute_obj.memory = compute_rocks["mem"]
-                compute_obj.cpus = compute_rocks["cpus"]
-                compute_obj.save()
-                try:
-                    cset = ComputeSet.objects.get(computes__id__exact=compute_obj.id,
-                                                  state__in=[ComputeSet.CSET_STATE_RUNNING])
-                    if (cset.state == ComputeSet.CSET_STATE_RUNNING
-                            and not cset.computes.filter(state="active")):
-                        cancel_computeset.delay(cset)
-                except ComputeSet.DoesNotExist:
-                    print "Computeset for compute %s not found" % compute_obj.name
-                except:
-                    print traceback.format_exc()
-
-            for interface in compute_rocks['interfaces']:
-                if interface["mac"]:
-                    if_obj, created = ComputeInterface.objects.update_or_create(compute=compute_obj, ip=interface["ip"], netmask=interface[
-                                                                                "netmask"], mac=interface["mac"], iface=interface["iface"], subnet=interface["subnet"])
+                 or compute_obj.memory != _clean(Compute, "memory", compute_rocks["mem"])
+                 or compute_obj.cpus != _clean(Compute, "cpus", compute_rocks["cpus"])):
+                if compute_obj.state != compute_rocks["state"]:
+                    events.append(StateEvent(
+                        kind=StateEvent.EVENT_KIND_COMPUTE,
+                        cluster=cluster_obj, object_id=compute_obj.id,
+                        name=compute_obj.name, old_state=compute_obj.state,
+                        state=compute_rocks["state"]))
+                changed_computes[compute_obj.pk] = {
+                    "state": compute_rocks["state"],
+                    "memory": compute_rocks["mem"],
+                    "cpus": compute_rocks["cpus"]}
+
+        if new_computes:
+            Compute.objects.bulk_create(new_computes)
+            # bulk_create() does not set the primary keys on MySQL
+            for compute_obj in Compute.objects.filter(cluster=cluster_obj):
+                computes.setdefault(compute_obj.rocks_name, compute_obj)
+        _bulk_update(Compute, changed_computes)
+        StateEvent.objects.bulk_create(events)
+
+        _sync_interfaces(ComputeInterface, "compute", compute_interfaces,
+                         [(computes[compute_rocks["name"]].pk, compute_rocks["interfaces"])
+                          for compute_rocks in cluster_rocks["computes"]])
+
+    return [event.object_id for event in events]
+
+
+def _cancel_idle_computesets(compute_ids):
+    """ Cancel the running computesets left without an active compute by the
+        state changes of compute_ids, with one scancel for all of them.
+    """
+    from django.db.models import Case, IntegerField, Sum, When
+    from api.models import ComputeSet
+
+    through = ComputeSet.computes.through
+    idle = {}
+    for chunk in _chunks(compute_ids):
+        idle.update(
+            (cset["id"], cset) for cset in ComputeSet.objects.filter(
+                id__in=through.objects.filter(
+                    compute__in=chunk).values("computeset"),
+                state=ComputeSet.CSET_STATE_RUNNING,
+                jobid__isnull=False,
+            ).annotate(active=Sum(Case(
+                When(computes__state="active", then=1),
+                default=0, output_field=IntegerField()))
+            ).filter(active=0).values("id", "jobid", "name"))
+
+    if idle:
+        cancel_computesets.delay(
+            [dict((field, cset[field]) for field in ("id", "jobid", "name"))
+             for cset in sorted(idle.values(), key=lambda cset: cset["id"])])
+
+
+def _clean(model, field, value):
+    """Convert a value reported by rocks to the type stored in the field."""
+    return model._meta.get_field(field).to_python(value)
+
+
+INTERFACE_FIELDS = ("ip", "netmask", "iface", "subnet")
+
+
+def _load_interfaces(model, owner, queryset, macs):
+    """ Load the interfaces in queryset and the ones with one of macs.
+        Returns them as {mac: (pk, owner_id, ip, netmask, iface, subnet)}
+        and their macs grouped by owner as {owner_id: set(macs)}.
+    """
+    fields = ("mac", "id", owner + "_id") + INTERFACE_FIELDS
+    interfaces = dict(
+        (row[0], row[1:]) for row in queryset.values_list(*fields))
+    # Interfaces that moved in from another cluster
+    missing = set(mac for mac in macs if mac) - set(interfaces)
+    for chunk in _chunks(missing):
+        interfaces.update(
+            (row[0], row[1:]) for row in
+            model.objects.filter(mac__in=chunk).values_list(*fields))
+
+    owned = {}
+    for mac, row in interfaces.iteritems():
+        owned.setdefault(row[1], set()).add(mac)
+    return (interfaces, owned)
+
+
+def _sync_interfaces(model, owner, loaded, owners_rocks):
+    """ Upsert the interfaces reported by rocks by mac and delete the ones
+        of the reported owners that are not reported anymore.
+
+        owners_rocks is a list of (owner pk, interfaces JSON) and loaded
+        is what _load_interfaces() returned, which is kept up to date.
+    """
+    (interfaces, owned) = loaded
+    new_interfaces = []
+    changes = {}
+    reported = set()
+    for owner_id, interfaces_rocks in owners_rocks:
+        for interface in interfaces_rocks:
+            if not interface["mac"]:
+                continue
+            reported.add(interface["mac"])
+            values = (owner_id, interface["ip"] or None,
+                      interface["netmask"] or None, interface["iface"],
+                      interface["subnet"])
+            row = interfaces.get(interface["mac"])
+            if row is None:
+                new_interfaces.append(model(
+                    mac=interface["mac"],
+                    **dict(zip((owner + "_id",) + INTERFACE_FIELDS, values))))
+            elif row[1:] != values:
+                changes[row[0]] = dict(zip((owner + "_id",) + INTERFACE_FIELDS, values))
+            interfaces[interface["mac"]] = (row and row[0],) + values
+            if row is not None and row[1] != owner_id:
+                owned[row[1]].discard(interface["mac"])
+            owned.setdefault(owner_id, set()).add(interface["mac"])
+
+    # Only the interfaces of the reported owners are looked at
+    gone = [mac for owner_id, interfaces_rocks in owners_rocks
+            for mac in owned.get(owner_id, ()) if mac not in reported]
+    for chunk in _chunks(gone):
+        model.objects.filter(mac__in=chunk).delete()
+    for mac in gone:
+        owned[interfaces.pop(mac)[1]].discard(mac)
+
+    model.objects.bulk_create(new_interfaces)
+    _bulk_update(model, changes)
+
+
+def _chunks(items, size=500):
+    """Split items in lists short enough for an IN lookup."""
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _bulk_update(model, changes):
+    """ Apply {pk: {field: value}} changes with one UPDATE per distinct set of
+        values, e.g. a single UPDATE when a whole rack changes state.
+    """
+    groups = {}
+    for pk, values in changes.items():
+        groups.setdefault(tuple(sorted(values.items())), []).append(pk)
+    for values, pks in groups.items():
+        for chunk in _chunks(pks):
+            model.objects.filter(pk__in=chunk).update(**dict(values))
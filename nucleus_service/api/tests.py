@@ -1,3 +1,952 @@
-from django.test import TestCase
+import copy
+import datetime
+import os
+import random
+import sys
+import time
+from collections import deque
+from StringIO import StringIO
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
+
+from api import auth, hostlist, tasks, views
+from api.auth import NucleusAPISignatureAuthentication
+from api.models import Cluster, Compute, ComputeAllocation, ComputeInterface
+from api.models import ComputeSet, StateEvent
+from api.models import Frontend, FrontendInterface, Nonce, NucleusUser
+from api.nonces import DatabaseNonceStore
+
+# #################################################
+#  HOT PATH BENCHMARKS
+# #################################################
+#
+# Seeds synthetic clusters and records the number of queries and the wall
+# time of the API hot paths. Set NUCLEUS_BENCH_COMPUTES (1000 to 50000) to
+# benchmark bigger machines, e.g.
+#
+#   NUCLEUS_BENCH_COMPUTES=50000 python manage.py test api.tests.HotPathBenchmarkTest
+
+BENCH_COMPUTES = int(os.environ.get('NUCLEUS_BENCH_COMPUTES', 1000))
+COMPUTES_PER_CLUSTER = 250
+INTERFACES_PER_COMPUTE = 2
+POWERON_NODES = 128
+
+# Upper bounds on the number of queries of each hot path. They must not grow
+# with the number of computes, so an N+1 regression breaks the run.
+QUERY_BUDGETS = {
+    'computeset poweron': 20,
+    'cluster list': 10,
+    'cluster detail': 10,
+    'computeset list': 10,
+    'update_clusters': 10,
+    'update_clusters interfaces': 12,
+    'update_clusters states': 12,
+}
+
+# Queries per cluster update_clusters may add to its budget for the
+# transaction each cluster is synced in
+UPDATE_CLUSTERS_QUERIES_PER_CLUSTER = 2
+
+# Upper bounds on the wall time of each hot path, in seconds per thousand
+# seeded computes
+TIME_BUDGETS = {
+    'computeset poweron': 2.0,
+    'cluster list': 10.0,
+    'cluster detail': 5.0,
+    'computeset list': 5.0,
+    'update_clusters': 2.0,
+    'update_clusters interfaces': 2.0,
+    'update_clusters states': 2.0,
+}
+
+
+class TaskStub(object):
+    """Stands in for a celery task, recording the messages sent to it."""
+
+    def __init__(self):
+        self.calls = []
+
+    def delay(self, *args):
+        self.calls.append(args)
+
+
+def seed_clusters(project, computes):
+    """Create synthetic clusters, returning them as update_clusters() JSON."""
+    clusters_json = []
+    macs = iter(xrange(1, sys.maxint))
+
+    def interface_json(subnet):
+        mac = next(macs)
+        return {
+            'ip': '10.%d.%d.%d' % (mac >> 16 & 255, mac >> 8 & 255, mac & 255),
+            'mac': ':'.join('%02x' % (mac >> shift & 255)
+                            for shift in range(40, -8, -8)),
+            'iface': 'eth%d' % (subnet == 'private'),
+            'netmask': '255.0.0.0',
+            'subnet': subnet,
+        }
+
+    for index in range(0, computes, COMPUTES_PER_CLUSTER):
+        name = 'bench%d' % (index // COMPUTES_PER_CLUSTER)
+        cluster_json = {
+            'frontend': name,
+            'vlan': 100 + index // COMPUTES_PER_CLUSTER,
+            'state': 'active',
+            'mem': 4096,
+            'cpus': 4,
+            'type': 'VM',
+            'interfaces': [interface_json('public'), interface_json('private')],
+            'computes': [{
+                'name': 'vm-%s-%d' % (name, number),
+                'state': 'nostate',
+                'mem': 8192,
+                'cpus': 24,
+                'type': 'VM',
+                'interfaces': [interface_json(subnet) for subnet in
+                               ('private', 'public')[:INTERFACES_PER_COMPUTE]],
+            } for number in range(
+                1, min(COMPUTES_PER_CLUSTER, computes - index) + 1)],
+        }
+        clusters_json.append(cluster_json)
+
+        frontend = Frontend.objects.create(
+            name=name, rocks_name=name, state=cluster_json['state'],
+            memory=cluster_json['mem'], cpus=cluster_json['cpus'],
+            type=cluster_json['type'])
+        FrontendInterface.objects.bulk_create([
+            FrontendInterface(frontend=frontend, **interface)
+            for interface in cluster_json['interfaces']])
+        cluster = Cluster.objects.create(
+            name=name, project=project, frontend=frontend,
+            vlan=cluster_json['vlan'], username='bench')
+        Compute.objects.bulk_create([
+            Compute(name=compute['name'], rocks_name=compute['name'],
+                    cluster=cluster, state=compute['state'],
+                    memory=compute['mem'], cpus=compute['cpus'],
+                    type=compute['type'])
+            for compute in cluster_json['computes']])
+        compute_ids = dict(Compute.objects.filter(
+            cluster=cluster).values_list('rocks_name', 'id'))
+        ComputeInterface.objects.bulk_create([
+            ComputeInterface(compute_id=compute_ids[compute['name']], **interface)
+            for compute in cluster_json['computes']
+            for interface in compute['interfaces']])
+
+    return clusters_json
+
+
+class HotPathBenchmarkTest(TestCase):
+    results = []
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Group.objects.create(name='bench')
+        cls.user = User.objects.create_user('bench', password='bench')
+        cls.user.groups.add(cls.project)
+        cls.clusters_json = seed_clusters(cls.project, BENCH_COMPUTES)
+
+        # Computeset history for the list view
+        cluster = Cluster.objects.get(name='bench0')
+        computes = list(Compute.objects.filter(cluster=cluster)[:64])
+        for offset in range(0, len(computes), 8):
+            cset = ComputeSet.objects.create(
+                cluster=cluster, user='bench', account='bench',
+                walltime_mins=60, node_count=8,
+                state=ComputeSet.CSET_STATE_COMPLETED)
+            cset.computes.add(*computes[offset:offset + 8])
+
+    @classmethod
+    def tearDownClass(cls):
+        super(HotPathBenchmarkTest, cls).tearDownClass()
+        sys.stderr.write("\n%-28s %8s %10s  (%d computes)\n" % (
+            "hot path", "queries", "seconds", BENCH_COMPUTES))
+        for name, queries, seconds in cls.results:
+            sys.stderr.write("%-28s %8d %10.3f\n" % (name, queries, seconds))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.submit_computeset = views.submit_computeset
+        views.submit_computeset = TaskStub()
+        self.cancel_computesets = tasks.cancel_computesets
+        tasks.cancel_computesets = TaskStub()
+
+    def tearDown(self):
+        views.submit_computeset = self.submit_computeset
+        tasks.cancel_computesets = self.cancel_computesets
+
+    def measure(self, name, func, *args, **kwargs):
+        """Run func, record its query count and wall time, check budgets."""
+        # Django only logs the last 9000 queries, which would cap the count
+        connection.queries_log = deque()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            result = func(*args, **kwargs)
+            seconds = time.time() - start
+        self.results.append((name, len(queries), seconds))
+
+        query_budget = QUERY_BUDGETS[name]
+        if name.startswith('update_clusters'):
+            query_budget += (UPDATE_CLUSTERS_QUERIES_PER_CLUSTER *
+                             len(self.clusters_json))
+        self.assertLessEqual(
+            len(queries), query_budget,
+            "%s ran %d queries, the budget is %d" % (
+                name, len(queries), query_budget))
+
+        time_budget = TIME_BUDGETS[name] * max(BENCH_COMPUTES / 1000.0, 1)
+        self.assertLessEqual(
+            seconds, time_budget,
+            "%s took %.3fs, the budget is %.3fs" % (name, seconds, time_budget))
+        return result
+
+    def test_computeset_poweron(self):
+        response = self.measure(
+            'computeset poweron', self.client.post, '/v1/computeset/',
+            {'cluster': 'bench0',
+             'computes': 'vm-bench0-[1-%d]' % POWERON_NODES},
+            format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['computes']), POWERON_NODES)
+
+    def test_cluster_list(self):
+        response = self.measure('cluster list', self.client.get, '/v1/cluster/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), len(self.clusters_json))
+
+    def test_cluster_detail(self):
+        response = self.measure(
+            'cluster detail', self.client.get, '/v1/cluster/bench0/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['computes']),
+                         len(self.clusters_json[0]['computes']))
+
+    def test_computeset_list(self):
+        response = self.measure(
+            'computeset list', self.client.get, '/v1/computeset/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 8)
+
+    def test_update_clusters_unchanged(self):
+        self.measure('update_clusters', tasks.update_clusters,
+                     self.clusters_json)
+        self.assertEqual(Compute.objects.count(), BENCH_COMPUTES)
+        self.assertEqual(ComputeInterface.objects.count(),
+                         BENCH_COMPUTES * INTERFACES_PER_COMPUTE)
+
+    def test_update_clusters_interfaces(self):
+        clusters_json = copy.deepcopy(self.clusters_json)
+        computes_json = clusters_json[0]['computes']
+        changed = computes_json[0]['interfaces'][0]
+        changed['ip'] = '192.168.0.1'
+        moved = computes_json[1]['interfaces'].pop()
+        computes_json[2]['interfaces'].append(moved)
+        removed = computes_json[3]['interfaces'].pop()
+        added = dict(removed, mac='ff:ff:ff:ff:ff:ff')
+        computes_json[4]['interfaces'].append(added)
+        frontend_ip = clusters_json[-1]['interfaces'][0]
+        frontend_ip['subnet'] = 'ipmi'
+
+        self.measure('update_clusters interfaces', tasks.update_clusters,
+                     clusters_json)
+        self.assertEqual(ComputeInterface.objects.get(mac=changed['mac']).ip,
+                         '192.168.0.1')
+        self.assertEqual(ComputeInterface.objects.get(
+            mac=moved['mac']).compute.name, computes_json[2]['name'])
+        self.assertFalse(ComputeInterface.objects.filter(
+            mac=removed['mac']).exists())
+        self.assertEqual(ComputeInterface.objects.get(
+            mac=added['mac']).compute.name, computes_json[4]['name'])
+        self.assertEqual(FrontendInterface.objects.get(
+            mac=frontend_ip['mac']).subnet, 'ipmi')
+        self.assertEqual(ComputeInterface.objects.count(),
+                         BENCH_COMPUTES * INTERFACES_PER_COMPUTE)
+
+    def test_update_clusters_states(self):
+        # A mass reboot of the rack of two running computesets, one of
+        # which keeps an active compute
+        cluster = Cluster.objects.get(name='bench1')
+        Compute.objects.filter(cluster=cluster).update(state='active')
+        computes = list(Compute.objects.filter(cluster=cluster)[:16])
+        csets = []
+        for offset in (0, 8):
+            cset = ComputeSet.objects.create(
+                cluster=cluster, user='bench', account='bench',
+                walltime_mins=60, node_count=8, jobid=1000 + offset,
+                name='bench-%d' % offset, state=ComputeSet.CSET_STATE_RUNNING)
+            cset.computes.add(*computes[offset:offset + 8])
+            csets.append(cset)
+
+        clusters_json = copy.deepcopy(self.clusters_json)
+        for compute in clusters_json[1]['computes']:
+            compute['state'] = 'active'
+            if compute['name'] != computes[-1].name:
+                compute['state'] = 'nostate'
+
+        self.measure('update_clusters states', tasks.update_clusters,
+                     clusters_json)
+        self.assertEqual(tasks.cancel_computesets.calls, [(
+            [{'id': csets[0].id, 'jobid': 1000, 'name': 'bench-0'}],)])
+        # Sent to the comet-fe1 worker that cancels the jobs
+        self.assertEqual(task_route('api.tasks.cancel_computesets'),
+                         {'routing_key': 'comet-fe1'})
+        self.assertEqual(Compute.objects.filter(
+            cluster=cluster, state='active').count(), 1)
+
+
+    def test_update_clusters_reports_failures(self):
+        report_sync_failures = tasks._report_sync_failures
+        reported = []
+        tasks._report_sync_failures = reported.append
+        try:
+            clusters_json = copy.deepcopy(self.clusters_json[:2])
+            del clusters_json[0]['computes'][0]['state']
+            tasks.update_clusters(clusters_json)
+            self.assertEqual(reported, [['bench0']])
+        finally:
+            tasks._report_sync_failures = report_sync_failures
+
+    def test_failed_sync_is_published_again(self):
+        import update_status
+        (result, state) = (self.clusters_json[:2], {'full_sync': 0,
+                                                    'hashes': {}})
+        (changed, state) = update_status.changed_clusters(
+            result, {}, state, update_status.FULL_SYNC_INTERVAL)
+        self.assertEqual(len(changed), 2)
+        (changed, _) = update_status.changed_clusters(
+            result, {}, state, update_status.FULL_SYNC_INTERVAL + 1)
+        self.assertEqual(changed, [])
+        (changed, _) = update_status.changed_clusters(
+            result, {}, state, update_status.FULL_SYNC_INTERVAL + 1,
+            set(['bench1']))
+        self.assertEqual([cluster['frontend'] for cluster in changed],
+                         ['bench1'])
+        # Failed to sync, then failed to collect: sent when it is back
+        (_, new_state) = update_status.changed_clusters(
+            result[:1], {'bench1': 'error'}, state,
+            update_status.FULL_SYNC_INTERVAL + 1, set(['bench1']))
+        self.assertNotIn('bench1', new_state['hashes'])
+
+
+# #################################################
+#  COMPUTESETS
+# #################################################
+
+
+class ComputeSetTest(TestCase):
+    """Functional tests of the ComputeSet API and its state transitions."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Group.objects.create(name='project')
+        cls.user = User.objects.create_user('user', password='user')
+        cls.user.groups.add(cls.project)
+        seed_clusters(cls.project, 16)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.submit_computeset = views.submit_computeset
+        views.submit_computeset = TaskStub()
+        cache.clear()
+
+    def tearDown(self):
+        views.submit_computeset = self.submit_computeset
+
+    def poweron(self, computes, **headers):
+        return self.client.post('/v1/computeset/', {
+            'cluster': 'bench0', 'computes': computes}, format='json',
+            **headers)
+
+    def test_failed_submission_releases_computes(self):
+        response = self.poweron('vm-bench0-[1-4]')
+        self.assertEqual(response.status_code, 201)
+        tasks.update_computeset({'id': response.data['id'], 'jobid': None,
+                                 'state': 'failed'})
+        self.assertFalse(ComputeAllocation.objects.exists())
+        self.assertEqual(self.poweron('vm-bench0-[1-4]').status_code, 201)
+
+    def test_failed_job_keeps_computes(self):
+        response = self.poweron('vm-bench0-[1-4]')
+        tasks.update_computeset({'id': response.data['id'], 'jobid': 42,
+                                 'state': 'submitted'})
+        tasks.update_computeset({'id': response.data['id'], 'state': 'failed'})
+        self.assertEqual(ComputeAllocation.objects.count(), 4)
+        self.assertEqual(self.poweron('vm-bench0-[1-4]').status_code, 400)
+
+    def test_submitted_event_has_name(self):
+        cset_id = self.poweron('vm-bench0-[1-4]').data['id']
+        tasks.update_computeset({'id': cset_id, 'name': 'VC-JOB-%d' % cset_id,
+                                 'jobid': '77', 'state': 'submitted'})
+        self.assertEqual(list(StateEvent.objects.filter(
+            object_id=cset_id).order_by('id').values_list('name', 'state')),
+            [(None, 'created'), ('VC-JOB-%d' % cset_id, 'submitted')])
+
+    def test_nodelist_expansions_are_cached(self):
+        (poweron_nodeset, poweroff_nodes) = (tasks.poweron_nodeset,
+                                             tasks.poweroff_nodes)
+        tasks.poweron_nodeset = tasks.poweroff_nodes = TaskStub()
+        hostlist._expand_cache.clear()
+        try:
+            cset_id = self.poweron('vm-bench0-[1-4]').data['id']
+            # The messages of the job, each with its nodelist
+            for state in ('submitted', 'running', 'ending', 'completed'):
+                tasks.update_computeset({'id': cset_id, 'state': state,
+                                         'nodelist': 'comet-01-[01-04]'})
+            self.assertEqual(list(tasks.poweron_nodeset.calls[0][1]),
+                             ['comet-01-%02d' % n for n in range(1, 5)])
+            info = hostlist.cache_info()
+            self.assertEqual((info['misses'], info['hits']), (1, 4))
+
+            # An invalid nodelist is not stored
+            tasks.update_computeset({'id': cset_id, 'nodelist': 'n[1-'})
+            self.assertEqual(ComputeSet.objects.get(id=cset_id).nodelist,
+                             'comet-01-[01-04]')
+        finally:
+            (tasks.poweron_nodeset, tasks.poweroff_nodes) = (poweron_nodeset,
+                                                             poweroff_nodes)
+
+    def test_poweron_idempotency_replay(self):
+        first = self.poweron('vm-bench0-[1-4]', HTTP_IDEMPOTENCY_KEY='retry')
+        self.assertEqual(first.status_code, 201)
+        retry = self.poweron('vm-bench0-[1-4]', HTTP_IDEMPOTENCY_KEY='retry')
+        self.assertEqual((retry.status_code, retry.data, retry['Location']),
+                         (201, first.data, first['Location']))
+        self.assertEqual(ComputeSet.objects.count(), 1)
+        self.assertEqual(len(views.submit_computeset.calls), 1)
+
+    def test_poweron_idempotency_pending(self):
+        # The key is claimed with the short pending TTL
+        timeouts = []
+        add = cache.add
+        cache.add = lambda key, value, timeout: (
+            timeouts.append(timeout) or add(key, value, timeout))
+        try:
+            self.poweron('vm-bench0-[1-4]', HTTP_IDEMPOTENCY_KEY='retry')
+        finally:
+            cache.add = add
+        self.assertEqual(timeouts, [settings.IDEMPOTENCY_PENDING_TTL])
+
+        # A request that died after claiming the key blocks retries only
+        # until the pending marker expires
+        cache.add('idempotency:%s:%s' % (self.user.pk, 'dead'),
+                  views.IDEMPOTENCY_PENDING, 1)
+        response = self.poweron('vm-bench0-[5-8]', HTTP_IDEMPOTENCY_KEY='dead')
+        self.assertEqual(response.status_code, 409)
+        time.sleep(1.1)
+        response = self.poweron('vm-bench0-[5-8]', HTTP_IDEMPOTENCY_KEY='dead')
+        self.assertEqual(response.status_code, 201)
+
+    def test_bulk_rejects_bad_ids(self):
+        for computesets in (1, [], ['a'], [1, None], [True], {'1': 2}):
+            response = self.client.put('/v1/computeset/bulk', {
+                'action': 'poweroff', 'computesets': computesets},
+                format='json')
+            self.assertEqual(response.status_code, 400, computesets)
+
+    def test_bulk_poweroff_completed_keeps_reused_computes(self):
+        poweroff_nodes = views.poweroff_nodes
+        views.poweroff_nodes = TaskStub()
+        try:
+            completed = self.poweron('vm-bench0-[1-4]').data['id']
+            tasks.update_computeset({'id': completed, 'state': 'completed'})
+            running = self.poweron('vm-bench0-[3-6]').data['id']
+            response = self.client.put('/v1/computeset/bulk', {
+                'action': 'poweroff', 'state': 'completed'}, format='json')
+            self.assertEqual(response.data, {'computesets': [completed]})
+            self.assertEqual(views.poweroff_nodes.calls, [])
+
+            response = self.client.put('/v1/computeset/bulk', {
+                'action': 'poweroff', 'computesets': [completed, running]},
+                format='json')
+            self.assertEqual(sorted(views.poweroff_nodes.calls[0][0]),
+                             ['vm-bench0-%d' % n for n in range(3, 7)])
+        finally:
+            views.poweroff_nodes = poweroff_nodes
+
+    def test_backfill_allocations(self):
+        cluster = Cluster.objects.get(name='bench0')
+        computes = list(Compute.objects.filter(cluster=cluster).order_by('id'))
+        csets = {}
+        for state, jobid, members in (('running', 1, computes[0:2]),
+                                      ('completed', 2, computes[2:4]),
+                                      ('failed', None, computes[4:6]),
+                                      ('failed', 3, computes[6:8])):
+            csets[state, jobid] = ComputeSet.objects.create(
+                cluster=cluster, user='user', account='project',
+                walltime_mins=60, node_count=2, jobid=jobid, state=state)
+            csets[state, jobid].computes.add(*members)
+        ComputeAllocation.objects.create(
+            computeset=csets['running', 1], compute=computes[0])
+
+        call_command('backfill_allocations', stdout=StringIO())
+        call_command('backfill_allocations', stdout=StringIO())
+        self.assertEqual(sorted(ComputeAllocation.objects.values_list(
+            'compute__name', 'computeset_id')), sorted(
+            (compute.name, cset.id) for (cset, members) in (
+                (csets['running', 1], computes[0:2]),
+                (csets['failed', 3], computes[6:8]))
+            for compute in members))
+        self.assertEqual(self.poweron(computes[4].name).status_code, 201)
+        self.assertEqual(self.poweron(computes[1].name).status_code, 400)
+
+    def test_poweron_allocation_race(self):
+        # The computes are claimed by a request racing this one, and
+        # released again before the conflicts are looked up
+        compute = Compute.objects.get(name='vm-bench0-1')
+        other = ComputeSet.objects.create(
+            cluster=compute.cluster, user='user', account='project',
+            walltime_mins=60, node_count=1)
+        ComputeAllocation.objects.create(computeset=other, compute=compute)
+        allocation_conflicts = views.allocation_conflicts
+        views.allocation_conflicts = lambda computes: None
+        try:
+            response = self.poweron('vm-bench0-[1-4]')
+        finally:
+            views.allocation_conflicts = allocation_conflicts
+        self.assertEqual(response.status_code, 409)
+
+# #################################################
+#  TASK ROUTING
+# #################################################
+
+
+def task_route(task, *args):
+    """Return the routing options celery publishes a task message with."""
+    from nucleus.celery import app
+    return app.amqp.router.route({}, task, args, {})
+
+
+class TaskRoutingTest(SimpleTestCase):
+
+    def test_fe1_tasks(self):
+        # These tasks run scancel, sbatch or rocks on comet-fe1
+        for task in ('submit_computeset', 'cancel_computeset',
+                     'cancel_computesets', 'poweron_nodeset', 'poweron_nodes',
+                     'poweroff_nodes', 'attach_iso'):
+            self.assertEqual(task_route('api.tasks.' + task).get(
+                'routing_key'), 'comet-fe1', task)
+
+    def test_update_partitions(self):
+        from nucleus import settings as nucleus_settings
+        queues = set()
+        for cset_id in range(64):
+            route = task_route('api.tasks.update_computeset', {'id': cset_id})
+            self.assertEqual(route, task_route(
+                'api.tasks.update_computeset', {'id': cset_id}))
+            queues.add(route['queue'].name)
+        self.assertEqual(queues, set(
+            'update.%d' % partition for partition in
+            range(nucleus_settings.UPDATE_QUEUE_PARTITIONS)))
+        self.assertIn(task_route('api.tasks.update_clusters', [
+            {'frontend': 'bench0'}])['queue'].name, queues)
+
+# #################################################
+#  EVENTS
+# #################################################
+
+
+class StateEventTest(TestCase):
+    """Tests of the event stream and of the retention of its events."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Group.objects.create(name='project')
+        cls.user = User.objects.create_user('user', password='user')
+        cls.user.groups.add(cls.project)
+        seed_clusters(cls.project, 1)
+        cls.cluster = Cluster.objects.get(name='bench0')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def event(self, state, kind=StateEvent.EVENT_KIND_COMPUTESET):
+        return StateEvent.objects.create(
+            kind=kind, cluster=self.cluster, object_id=1, name='cset',
+            old_state='created', state=state)
+
+    def poll(self, since, timeout=0):
+        response = self.client.get('/v1/event/', {
+            'since': since, 'timeout': timeout})
+        self.assertEqual(response.status_code, 200)
+        return (response.data['since'],
+                [event['id'] for event in response.data['events']])
+
+    def settle(self, *events):
+        StateEvent.objects.filter(id__in=[event.id for event in events]).update(
+            created=timezone.now() - datetime.timedelta(
+                seconds=views.StateEventView.SETTLE_TIME + 1))
+
+    def test_resume_since(self):
+        first = self.event('submitted')
+        second = self.event('running')
+        self.assertEqual(self.poll(first.id - 1),
+                         (second.id, [first.id, second.id]))
+        third = self.event('completed')
+        self.assertEqual(self.poll(second.id), (third.id, [third.id]))
+        self.assertEqual(self.poll(third.id), (third.id, []))
+
+    def test_gap_holds_back_later_events(self):
+        # The middle event stands for a transaction that has not committed
+        first = self.event('submitted')
+        missing = self.event('running')
+        third = self.event('completed')
+        missing.delete()
+        self.assertEqual(self.poll(first.id - 1), (first.id, [first.id]))
+
+        # Once settled the gap is a rolled back transaction and is skipped
+        self.settle(third)
+        self.assertEqual(self.poll(first.id), (third.id, [third.id]))
+
+    def test_waiters_are_capped(self):
+        view = views.StateEventView
+        view.waiters = view.MAX_WAITERS
+        try:
+            start = time.time()
+            self.assertEqual(self.poll(0, timeout=view.MAX_TIMEOUT)[1], [])
+            self.assertLess(time.time() - start, view.POLL_INTERVAL)
+        finally:
+            view.waiters = 0
+
+    def test_transition_metrics(self):
+        # Two computesets each created, then submitted 10 and 30 seconds
+        # later, the first one before the window
+        now = timezone.now()
+        window = now - datetime.timedelta(hours=1)
+        for object_id, offset in ((1, 10), (2, 30)):
+            for old_state, state, created in (
+                    (None, 'created', window - datetime.timedelta(seconds=60)),
+                    ('created', 'submitted', window - datetime.timedelta(
+                        seconds=60 - offset))):
+                event = StateEvent.objects.create(
+                    kind=StateEvent.EVENT_KIND_COMPUTESET, cluster=self.cluster,
+                    object_id=object_id, old_state=old_state, state=state)
+                StateEvent.objects.filter(id=event.id).update(created=created)
+        StateEvent.objects.filter(object_id=2).update(
+            created=models.F('created') + datetime.timedelta(minutes=30))
+
+        response = self.client.get('/v1/metrics/transition', {
+            'since': window.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(metric['old_state'], metric['state'], metric['count'],
+              metric['p50']) for metric in response.data['transitions']],
+            [('created', 'submitted', 1, 30.0)])
+
+    def test_purge_state_events(self):
+        compute = StateEvent.EVENT_KIND_COMPUTE
+        old = [self.event('active', compute) for _ in range(5)]
+        # The computeset transitions are kept for the metrics
+        transition = self.event('running')
+        recent = self.event('active', compute)
+        StateEvent.objects.filter(
+            id__in=[event.id for event in old + [transition]]).update(
+            created=timezone.now() - datetime.timedelta(
+                seconds=settings.STATE_EVENT_RETENTION + 1))
+        batch_size = tasks.PURGE_BATCH_SIZE
+        tasks.PURGE_BATCH_SIZE = 2
+        try:
+            tasks.purge_state_events()
+        finally:
+            tasks.PURGE_BATCH_SIZE = batch_size
+        self.assertEqual(list(StateEvent.objects.order_by('id').values_list(
+            'id', flat=True)), [transition.id, recent.id])
+
+# #################################################
+#  AUTHENTICATION CACHES
+# #################################################
+#
+# Another API process is simulated by changing the database without the
+# signals, and the shared auth_version() the way its signals would.
+
+
+class AuthCacheTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', password='user')
+        NucleusUser.objects.create(key_name='key', user=cls.user,
+                                   secret='secret')
+
+    def setUp(self):
+        cache.clear()
+        for ttl_cache in (auth.api_keys, auth.user_projects,
+                          auth.verified_credentials):
+            ttl_cache.invalidate()
+
+    def fetch_user_data(self, api_key):
+        """Return the secret of an API key and the queries it took."""
+        with CaptureQueriesContext(connection) as queries:
+            data = NucleusAPISignatureAuthentication().fetch_user_data(
+                api_key)
+        return (data and data[1], len(queries))
+
+    def test_api_key_hit(self):
+        self.assertEqual(self.fetch_user_data('key')[0], 'secret')
+        self.assertEqual(self.fetch_user_data('key'), ('secret', 0))
+
+    def test_api_key_miss(self):
+        (secret, queries) = self.fetch_user_data('unknown')
+        self.assertIsNone(secret)
+        self.assertGreater(queries, 0)
+
+    def test_api_key_changed_by_another_process(self):
+        self.fetch_user_data('key')
+        NucleusUser.objects.filter(key_name='key').update(secret='changed')
+        self.assertEqual(self.fetch_user_data('key'), ('secret', 0))
+        auth.change_auth_version(self.user.pk)
+        self.assertEqual(self.fetch_user_data('key')[0], 'changed')
+
+    def authenticate(self, password):
+        """Return the user of basic auth credentials and the queries."""
+        with CaptureQueriesContext(connection) as queries:
+            try:
+                (user, _) = auth.NucleusBasicAuthentication(
+                    ).authenticate_credentials('user', password)
+            except AuthenticationFailed:
+                user = None
+        return (user and user.username, len(queries))
+
+    def test_credentials_hit(self):
+        self.assertEqual(self.authenticate('user')[0], 'user')
+        self.assertEqual(self.authenticate('user'), ('user', 0))
+
+    def test_credentials_miss(self):
+        self.authenticate('user')
+        (user, queries) = self.authenticate('wrong')
+        self.assertIsNone(user)
+        self.assertGreater(queries, 0)
+        # Refused credentials are not remembered
+        self.assertGreater(self.authenticate('wrong')[1], 0)
+
+    def test_password_changed_by_another_process(self):
+        self.authenticate('user')
+        user = User.objects.get(pk=self.user.pk)
+        user.set_password('changed')
+        User.objects.filter(pk=user.pk).update(password=user.password)
+        auth.change_auth_version(user.pk)
+        self.assertEqual(self.authenticate('user')[0], None)
+        self.assertEqual(self.authenticate('changed')[0], 'user')
+
+    def test_deactivated_by_another_process(self):
+        self.authenticate('user')
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        auth.change_auth_version(self.user.pk)
+        self.assertEqual(self.authenticate('user')[0], None)
+
+    def test_version_evicted(self):
+        self.fetch_user_data('key')
+        NucleusUser.objects.filter(key_name='key').update(secret='changed')
+        # Changed by another process, then evicted from the shared cache
+        auth.change_auth_version(self.user.pk)
+        cache.delete(auth.AUTH_VERSION_KEY % self.user.pk)
+        self.assertEqual(self.fetch_user_data('key')[0], 'changed')
+        self.assertEqual(self.fetch_user_data('key'), ('changed', 0))
+
+    def test_credentials_version_evicted(self):
+        self.authenticate('user')
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        auth.change_auth_version(self.user.pk)
+        cache.delete(auth.AUTH_VERSION_KEY % self.user.pk)
+        self.assertEqual(self.authenticate('user')[0], None)
+
+    def test_version_unavailable(self):
+        self.fetch_user_data('key')
+        auth_version = auth.auth_version
+        auth.auth_version = lambda user_id: None
+        try:
+            self.assertGreater(self.fetch_user_data('key')[1], 0)
+        finally:
+            auth.auth_version = auth_version
+
+    def test_api_key_project_added(self):
+        self.fetch_user_data('key')
+        project = Group.objects.create(name='project')
+        project.user_set.add(self.user)
+        (user, secret) = NucleusAPISignatureAuthentication().fetch_user_data(
+            'key')
+        self.assertEqual(user.project_ids, frozenset([project.id]))
+
+
+# #################################################
+#  NONCES
+# #################################################
+
+
+class NonceStoreTest(TestCase):
+
+    def test_purge_nonces(self):
+        window = NucleusAPISignatureAuthentication.TIME_BACK
+        store = DatabaseNonceStore(window)
+        now = int(time.time())
+        for nonce in range(5):
+            self.assertTrue(store.add('old%d' % nonce, now - 3 * window))
+        self.assertTrue(store.add('recent', now))
+        self.assertFalse(store.add('recent', now))
+        batch_size = tasks.PURGE_BATCH_SIZE
+        tasks.PURGE_BATCH_SIZE = 2
+        try:
+            tasks.purge_nonces()
+        finally:
+            tasks.PURGE_BATCH_SIZE = batch_size
+        self.assertEqual(list(Nonce.objects.values_list('nonce', flat=True)),
+                         ['recent'])
+
+
+# #################################################
+#  HOSTLIST REGRESSION
+# #################################################
+#
+# Regression fixtures of api/hostlist.py: the expected hosts and compressed
+# node lists are what this module returns today, not the output of Slurm
+# (scontrol only ranges the last number of a host name, for instance). The
+# throughput of each operation is recorded so a faster hostlist engine can
+# be checked against the same corpus. The round trip checks run on random
+# host lists, seeded by NUCLEUS_HOSTLIST_SEED, e.g.
+#
+#   NUCLEUS_HOSTLIST_SEED=42 python manage.py test api.tests.HostlistRegressionTest
+
+HOSTLIST_SEED = int(os.environ.get('NUCLEUS_HOSTLIST_SEED', 0))
+HOSTLIST_ROUND_TRIPS = 200
+
+# (node list, number of hosts, first host, last host, compressed node list)
+HOSTLIST_CORPUS = [
+    ('comet-14-01', 1, 'comet-14-01', 'comet-14-01', 'comet-14-01'),
+    ('tux[1,3-5],node0', 5, 'tux1', 'node0', 'node0,tux[1,3-5]'),
+    ('n[9-11]', 3, 'n9', 'n11', 'n[9-11]'),
+    ('n[08-10]', 3, 'n08', 'n10', 'n[08-10]'),
+    ('x[00-2]', 3, 'x00', 'x02', 'x[00-02]'),
+    ('n[8-9],n[010-012]', 5, 'n8', 'n012', 'n[8-9,010-012]'),
+    ('n[1-3],n[2-5]', 5, 'n1', 'n5', 'n[1-5]'),
+    ('comet-[01-27]-[01-72]', 1944, 'comet-01-01', 'comet-27-72',
+     'comet-[01-27]-[01-72]'),
+    ('gpu-[1-2]-[001-002].sdsc.edu', 4, 'gpu-1-001.sdsc.edu',
+     'gpu-2-002.sdsc.edu', 'gpu-[1-2]-[001-002].sdsc.edu'),
+    ('vm-comet-[1-8],comet-fe1', 9, 'vm-comet-1', 'comet-fe1',
+     'comet-fe1,vm-comet-[1-8]'),
+    ('n[0-099999]', 100000, 'n0', 'n99999', 'n[0-99999]'),
+    ('n[000000-099999]', 100000, 'n000000', 'n099999', 'n[000000-099999]'),
+]
+
+BAD_HOSTLISTS = ['n[1-2', 'n1-2]', 'n[2-1]', 'n[a-b]', 'n[1-2-3]',
+                 'n[0-%d]' % hostlist.MAX_SIZE]
+
+
+def random_hosts(rand):
+    """Return a random list of hosts in the shapes clusters use."""
+    shapes = ['comet-%02d-%02d', 'vm-comet-%d-%d', 'n%d-%03d', 'gpu%d-%d']
+    hosts = []
+    for _ in range(rand.randint(1, 5)):
+        shape = rand.choice(shapes)
+        first = rand.randint(0, 30)
+        for rack in range(first, first + rand.randint(1, 4)):
+            low = rand.randint(0, 1100)
+            hosts.extend(shape % (rack, number) for number in range(
+                low, low + rand.randint(1, 50)) if rand.random() < 0.8)
+    return hosts
+
+
+class HostlistRegressionTest(SimpleTestCase):
+    results = []
+
+    @classmethod
+    def tearDownClass(cls):
+        super(HostlistRegressionTest, cls).tearDownClass()
+        sys.stderr.write("\n%-8s %-30s %8s %12s\n" % (
+            "hostlist", "node list", "hosts", "hosts/second"))
+        for operation, nodelist, hosts, seconds in cls.results:
+            sys.stderr.write("%-8s %-30.30s %8d %12.0f\n" % (
+                operation, nodelist, hosts, hosts / max(seconds, 1e-6)))
+
+    def measure(self, operation, nodelist, hosts, func, *args):
+        """Run func and record the hosts it handled per second."""
+        start = time.time()
+        result = func(*args)
+        self.results.append((operation, nodelist, hosts, time.time() - start))
+        return result
+
+    def test_corpus(self):
+        for nodelist, count, first, last, collected in HOSTLIST_CORPUS:
+            hosts = self.measure('expand', nodelist, count,
+                                 hostlist.expand_hostlist, nodelist)
+            self.assertEqual((len(hosts), hosts[0], hosts[-1]),
+                             (count, first, last), nodelist)
+            self.assertEqual(self.measure(
+                'collect', nodelist, count, hostlist.collect_hostlist, hosts),
+                collected, nodelist)
+            host_set = self.measure('hostset', nodelist, count,
+                                    hostlist.HostSet.from_hostlist, nodelist)
+            # A HostSet only compresses the rightmost number of the hosts
+            self.assertEqual(len(host_set), count, nodelist)
+            self.assertEqual(sorted(hostlist.expand_hostlist(
+                host_set.to_hostlist())), sorted(hosts), nodelist)
+
+    def test_bad_hostlists(self):
+        for nodelist in BAD_HOSTLISTS:
+            self.assertRaises(hostlist.BadHostlist,
+                              hostlist.expand_hostlist, nodelist)
+            self.assertRaises(hostlist.BadHostlist,
+                              hostlist.HostSet.from_hostlist, nodelist)
+
+    def test_round_trips(self):
+        rand = random.Random(HOSTLIST_SEED)
+        for _ in range(HOSTLIST_ROUND_TRIPS):
+            hosts = random_hosts(rand)
+            rand.shuffle(hosts)
+            collected = hostlist.collect_hostlist(hosts)
+            expanded = hostlist.expand_hostlist(collected)
+            self.assertEqual(sorted(expanded), sorted(set(hosts)), collected)
+            self.assertEqual(hostlist.collect_hostlist(expanded), collected)
+            host_set = hostlist.HostSet(hosts)
+            self.assertEqual(hostlist.HostSet.from_hostlist(collected), host_set)
+            self.assertEqual(sorted(hostlist.expand_hostlist(
+                host_set.to_hostlist())), sorted(expanded))
+
+            # Splitting the hosts in two and joining the sets again
+            half = len(hosts) // 2
+            (left, right) = (hostlist.HostSet(hosts[:half]),
+                             hostlist.HostSet(hosts[half:]))
+            self.assertEqual(left | right, host_set)
+            self.assertEqual(len(left - right) + len(right),
+                             len(set(hosts)))
+
+
+class HostlistCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = hostlist.LRUCache(4, 100, lambda key, hosts: len(hosts))
+
+    def expand(self, nodelist):
+        return self.cache.get(nodelist, lambda: tuple(
+            hostlist.expand_hostlist(nodelist)))
+
+    def test_hit(self):
+        self.assertEqual(self.expand('n[1-3]'), ('n1', 'n2', 'n3'))
+        self.assertEqual(self.expand('n[1-3]'), ('n1', 'n2', 'n3'))
+        info = self.cache.info()
+        self.assertEqual((info['hits'], info['misses'], info['hosts']),
+                         (1, 1, 3))
+
+    def test_bounded_by_hosts(self):
+        for first in range(0, 200, 40):
+            self.expand('n[%d-%d]' % (first, first + 39))
+        info = self.cache.info()
+        self.assertEqual((info['size'], info['hosts']), (2, 80))
+        # The most recently used ones are kept
+        self.expand('n[160-199]')
+        self.assertEqual(self.cache.info()['hits'], 1)
+
+    def test_large_result_not_cached(self):
+        self.assertEqual(len(self.expand('n[1-101]')), 101)
+        info = self.cache.info()
+        self.assertEqual((info['size'], info['hosts']), (0, 0))
@@ -1,5 +1,5 @@
 from django.conf.urls import patterns, include, url
-from rest_framework.routers import Route, DynamicDetailRoute
+from rest_framework.routers import Route, DynamicDetailRoute, DynamicListRoute
 from rest_framework_nested.routers import SimpleRouter, NestedSimpleRouter
 
 import views
@@ -71,6 +71,11 @@ class ComputeSetRouter(SimpleRouter):
             name='{basename}-list',
             initkwargs={'suffix': 'List'}
         ),
+        DynamicListRoute(
+            url=r'^{prefix}/{methodname}$',
+            name='{basename}-{methodname}',
+            initkwargs={}
+        ),
         Route(
             url=r'^{prefix}/{lookup}/$',
             mapping={'get': 'retrieve'},
@@ -143,5 +148,14 @@ urlpatterns = patterns(
     # Projects
     #
     url(r'^project', views.ProjectListView.as_view(), name='rest_user_projects'),
+    #
+    # Events
+    #
+    url(r'^event', views.StateEventView.as_view(), name='rest_events'),
+    #
+    # Metrics
+    #
+    url(r'^metrics/transition', views.TransitionMetricsView.as_view(),
+        name='rest_transition_metrics'),
     url(r'^image', views.ImageUploadView.as_view(), name='rest_images')
 )
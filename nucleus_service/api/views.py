@@ -1,12 +1,22 @@
+import datetime
 import hashlib
 import json
+import math
 import subprocess
+import threading
+import time
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
+from django.db import IntegrityError, transaction
+from django.db.models import Max
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from rest_framework import status
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import detail_route, list_route
 from rest_framework.generics import RetrieveUpdateAPIView, ListAPIView
 from rest_framework.parsers import FileUploadParser
 from rest_framework.permissions import IsAuthenticated
@@ -14,13 +24,15 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, ViewSet
 
+from auth import project_ids
 from tasks import poweron_nodes, poweroff_nodes
-from tasks import submit_computeset, cancel_computeset, attach_iso
+from tasks import submit_computeset, cancel_computeset, cancel_computesets, attach_iso
 import hostlist
-from models import Cluster, Compute, ComputeSet
+from models import Cluster, Compute, ComputeAllocation, ComputeSet
+from models import StateEvent
 from serializers import ComputeSerializer, ComputeSetSerializer, FullComputeSetSerializer
 from serializers import ClusterSerializer, FrontendSerializer, ProjectSerializer
-from serializers import UserDetailsSerializer
+from serializers import StateEventSerializer, UserDetailsSerializer
 
 # #################################################
 #  CLUSTER
@@ -34,13 +46,14 @@ class ClusterViewSet(ModelViewSet):
     def get_queryset(self):
         """Obtain details about all clusters."""
         clusters = Cluster.objects.filter(
-            project__in=self.request.user.groups.all())
-        return clusters
+            project__in=project_ids(self.request.user))
+        return ClusterSerializer.setup_eager_loading(clusters)
 
     def retrieve(self, request, cluster_name, format=None):
         """Obtain details about the named cluster."""
-        clust = get_object_or_404(Cluster, name=cluster_name)
-        if not clust.project in request.user.groups.all():
+        clust = get_object_or_404(
+            ClusterSerializer.setup_eager_loading(Cluster.objects), name=cluster_name)
+        if not clust.project_id in project_ids(request.user):
             raise PermissionDenied()
         serializer = ClusterSerializer(clust)
         return Response(serializer.data)
@@ -63,7 +76,7 @@ class ComputeViewSet(ViewSet):
         """Obtain the details of a named compute resource in a named cluster."""
         compute = get_object_or_404(
             Compute, name=compute_name, cluster__name=compute_name_cluster_name)
-        if not compute.cluster.project in request.user.groups.all():
+        if not compute.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
         serializer = ComputeSerializer(compute)
         return Response(serializer.data)
@@ -78,7 +91,7 @@ class ComputeViewSet(ViewSet):
         """
         compute = get_object_or_404(
             Compute, name=compute_name, cluster__name=compute_name_cluster_name)
-        if not compute.cluster.project in request.user.groups.all:
+        if not compute.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
         poweroff_nodes.delay([compute.rocks_name], "shutdown")
         return Response(status=204)
@@ -89,7 +102,7 @@ class ComputeViewSet(ViewSet):
         """
         compute = get_object_or_404(
             Compute, name=compute_name, cluster__name=compute_name_cluster_name)
-        if not compute.cluster.project in request.user.groups.all():
+        if not compute.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
         poweroff_nodes.delay([compute.rocks_name], "reboot")
         return Response(status=204)
@@ -100,7 +113,7 @@ class ComputeViewSet(ViewSet):
         """
         compute = get_object_or_404(
             Compute, name=compute_name, cluster__name=compute_name_cluster_name)
-        if not compute.cluster.project in request.user.groups.all():
+        if not compute.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
         poweroff_nodes.delay([compute.rocks_name], "reset")
         return Response(status=204)
@@ -111,7 +124,7 @@ class ComputeViewSet(ViewSet):
         """
         compute = get_object_or_404(
             Compute, name=compute_name, cluster__name=compute_name_cluster_name)
-        if not compute.cluster.project in request.user.groups.all():
+        if not compute.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
         poweroff_nodes.delay([compute.rocks_name], "poweroff")
         return Response(status=204)
@@ -122,7 +135,7 @@ class ComputeViewSet(ViewSet):
         """
         compute = get_object_or_404(
             Compute, name=compute_name, cluster__name=compute_name_cluster_name)
-        if not compute.cluster.project in request.user.groups.all():
+        if not compute.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
         poweron_nodes.delay([compute.rocks_name])
         return Response(status=204)
@@ -133,7 +146,7 @@ class ComputeViewSet(ViewSet):
         """
         compute = get_object_or_404(
             Compute, name=compute_name, cluster__name=compute_name_cluster_name)
-        if not compute.cluster.project in request.user.groups.all():
+        if not compute.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
         if not "iso_name" in request.GET:
             return Response("Please provide the iso_name", status=400)
@@ -231,7 +244,7 @@ class ConsoleViewSet(ViewSet):
     def retrieve(self, request, compute_name_cluster_name, console_compute_name, format=None):
         compute = get_object_or_404(
             Compute, name=console_compute_name, cluster__name=compute_name_cluster_name)
-        if not compute.cluster.project in request.user.groups.all():
+        if not compute.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
         return get_console(console_compute_name)
 
@@ -241,7 +254,7 @@ class FrontendConsoleViewSet(ViewSet):
 
     def retrieve(self, request, console_cluster_name, format=None):
         clust = get_object_or_404(Cluster, name=console_cluster_name)
-        if not clust.project in request.user.groups.all():
+        if not clust.project_id in project_ids(request.user):
             raise PermissionDenied()
         return get_console(clust.frontend.rocks_name)
 
@@ -250,6 +263,10 @@ class FrontendConsoleViewSet(ViewSet):
 #  COMPUTESET
 # #################################################
 
+# Marks an Idempotency-Key whose first request has not completed yet
+IDEMPOTENCY_PENDING = "pending"
+
+
 class ComputeSetViewSet(ModelViewSet):
     lookup_field = 'computeset_id'
     serializer_class = ComputeSetSerializer
@@ -257,17 +274,18 @@ class ComputeSetViewSet(ModelViewSet):
     def get_queryset(self):
         """Obtain the details of all ComputeSets."""
         cset = ComputeSet.objects.filter(
-            cluster__project__in=self.request.user.groups.all())
+            cluster__project__in=project_ids(self.request.user))
 
         state = self.request.query_params.get('state', None)
         if state is not None:
             cset = cset.filter(state=state)
-        return cset
+        return ComputeSetSerializer.setup_eager_loading(cset)
 
     def retrieve(self, request, computeset_id, format=None):
         """Obtain the details of the identified ComputeSet."""
-        cset = get_object_or_404(ComputeSet, pk=computeset_id)
-        if not cset.cluster.project in request.user.groups.all():
+        cset = get_object_or_404(
+            ComputeSetSerializer.setup_eager_loading(ComputeSet.objects), pk=computeset_id)
+        if not cset.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
         serializer = ComputeSetSerializer(cset)
         return Response(serializer.data)
@@ -276,7 +294,7 @@ class ComputeSetViewSet(ModelViewSet):
     def poweroff(self, request, computeset_id, format=None):
         """Power off the identified ComputeSet."""
         cset = ComputeSet.objects.get(pk=computeset_id)
-        if not cset.cluster.project in request.user.groups.all():
+        if not cset.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
 
         computes = []
@@ -290,9 +308,42 @@ class ComputeSetViewSet(ModelViewSet):
         return Response(status=204)
 
     def poweron(self, request, format=None):
-        """ Power on a set of computes creating a ComputeSet."""
+        """ Power on a set of computes creating a ComputeSet.
+
+        A retry carrying the Idempotency-Key header of an earlier successful
+        request from the same user gets the original response back.
+        """
+        idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not idempotency_key:
+            return self.create_computeset(request)
+
+        cache_key = "idempotency:%s:%s" % (request.user.pk, idempotency_key)
+        if not cache.add(cache_key, IDEMPOTENCY_PENDING,
+                         settings.IDEMPOTENCY_PENDING_TTL):
+            stored = cache.get(cache_key)
+            if stored == IDEMPOTENCY_PENDING:
+                return Response("A request with this Idempotency-Key is in progress",
+                                status=status.HTTP_409_CONFLICT)
+            if stored is not None:
+                data, location = stored
+                return Response(data, status=201, headers={'Location': location})
+
+        try:
+            response = self.create_computeset(request)
+        except:
+            cache.delete(cache_key)
+            raise
+        if response.status_code == 201:
+            cache.set(cache_key, (response.data, response['Location']),
+                      settings.IDEMPOTENCY_KEY_TTL)
+        else:
+            cache.delete(cache_key)
+        return response
+
+    def create_computeset(self, request):
+        """Create the ComputeSet described by a poweron request."""
         clust = get_object_or_404(Cluster, name=request.data["cluster"])
-        if not clust.project in request.user.groups.all():
+        if not clust.project_id in project_ids(request.user):
             raise PermissionDenied()
 
         walltime_mins = request.data.get("walltime_mins")
@@ -315,34 +366,57 @@ class ComputeSetViewSet(ModelViewSet):
             return Response("The length of hosts should be equal to length of nodes",
                             status=status.HTTP_400_BAD_REQUEST)
 
-        cset = ComputeSet()
-        cset.cluster = clust
-        cset.user = self.request.user.username
-        cset.account = clust.project
-        cset.walltime_mins = walltime_mins
-        cset.jobid = None
-        cset.name = None
-        cset.nodelist = ""
-        cset.state = ComputeSet.CSET_STATE_CREATED
-        cset.node_count = len(nodes)
-        cset.save()
-
-        for node in nodes:
-            compute = Compute.objects.get(name=node, cluster=clust)
-
-            other_cs_query = ComputeSet.objects.filter(computes__id__exact=compute.id).exclude(
-                state__exact=ComputeSet.CSET_STATE_COMPLETED)
-            if other_cs_query.exists():
-                cset.delete()
-                err_cs = other_cs_query.get()
-                return Response("The compute %s belongs to computeset %s which is in %s state" % (node, err_cs.id, err_cs.state), status=status.HTTP_400_BAD_REQUEST)
-
-            if compute.cluster.name != request.data["cluster"]:
-                cset.delete()
-                return Response("The node %s does not belong to the cluster %s, belongs to %s" % (node, request.data["cluster"], compute.cluster.name), status=status.HTTP_400_BAD_REQUEST)
-
-            cset.computes.add(compute)
-
+        # Resolve all the requested names with a single query.
+        computes = dict(
+            (compute.name, compute)
+            for compute in Compute.objects.filter(name__in=nodes, cluster=clust))
+        missing = [node for node in nodes if node not in computes]
+        if missing:
+            return Response("The nodes %s do not belong to the cluster %s" % (
+                ", ".join(missing), clust.name), status=status.HTTP_400_BAD_REQUEST)
+
+        # Fail early if any requested compute is already allocated.
+        conflicts = allocation_conflicts(computes.values())
+        if conflicts:
+            return conflicts
+
+        try:
+            with transaction.atomic():
+                cset = ComputeSet()
+                cset.cluster = clust
+                cset.user = self.request.user.username
+                cset.account = clust.project
+                cset.walltime_mins = walltime_mins
+                cset.jobid = None
+                cset.name = None
+                cset.nodelist = ""
+                cset.state = ComputeSet.CSET_STATE_CREATED
+                cset.node_count = len(nodes)
+                cset.save()
+
+                # The time the ComputeSet entered its first state
+                StateEvent.objects.create(
+                    kind=StateEvent.EVENT_KIND_COMPUTESET, cluster=clust,
+                    object_id=cset.id, name=cset.name, old_state=None,
+                    state=cset.state)
+
+                ComputeSet.computes.through.objects.bulk_create([
+                    ComputeSet.computes.through(computeset=cset, compute=compute)
+                    for compute in computes.values()])
+
+                # The unique compute allocation is the double-booking guard
+                # when another request claims the same computes concurrently.
+                ComputeAllocation.objects.bulk_create([
+                    ComputeAllocation(computeset=cset, compute=compute)
+                    for compute in computes.values()])
+        except IntegrityError:
+            # The computes that were claimed may have been released since
+            return allocation_conflicts(computes.values()) or Response(
+                "The allocation of the computes changed, retry the request",
+                status=status.HTTP_409_CONFLICT)
+
+        cset = ComputeSetSerializer.setup_eager_loading(
+            ComputeSet.objects).get(pk=cset.pk)
         submit_computeset.delay(FullComputeSetSerializer(cset).data)
 
         # We should only poweron computes after entering jobscript and
@@ -360,11 +434,63 @@ class ComputeSetViewSet(ModelViewSet):
 
         return response
 
+    @list_route(methods=['put'])
+    def bulk(self, request, format=None):
+        """Shutdown, power off, reboot or reset several ComputeSets at once.
+
+        Takes the action and either a list of computeset ids or a state
+        selecting all the user's ComputeSets in that state.
+        """
+        action = request.data.get("action")
+        if action not in ("shutdown", "poweroff", "reboot", "reset"):
+            return Response("The action should be one of shutdown, poweroff, reboot or reset",
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        csets = ComputeSet.objects.filter(
+            cluster__project__in=project_ids(request.user))
+        if request.data.get("computesets") is not None:
+            ids = request.data["computesets"]
+            if (not isinstance(ids, list) or not ids or
+                    [cset_id for cset_id in ids
+                     if not isinstance(cset_id, (int, long)) or
+                     isinstance(cset_id, bool)]):
+                return Response("The computesets should be a list of ids",
+                                status=status.HTTP_400_BAD_REQUEST)
+            ids = set(ids)
+            csets = list(csets.filter(pk__in=ids).values(
+                "id", "jobid", "name", "state"))
+            if len(csets) != len(ids):
+                raise PermissionDenied()
+        elif request.data.get("state"):
+            csets = list(csets.filter(state=request.data["state"]).values(
+                "id", "jobid", "name", "state"))
+        else:
+            return Response("Please provide the computesets or the state",
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Only the computes the ComputeSets still hold, those of completed
+        # ones may belong to other ComputeSets by now
+        ids = [cset["id"] for cset in csets]
+        computes = list(ComputeAllocation.objects.filter(
+            computeset__in=ids).values_list("compute__rocks_name", flat=True))
+        if computes:
+            poweroff_nodes.delay(computes, action)
+
+        if action in ("shutdown", "poweroff"):
+            jobs = [{"id": cset["id"], "jobid": cset["jobid"], "name": cset["name"]}
+                    for cset in csets
+                    if cset["jobid"] is not None
+                    and cset["state"] != ComputeSet.CSET_STATE_COMPLETED]
+            if jobs:
+                cancel_computesets.delay(jobs)
+
+        return Response({"computesets": sorted(ids)})
+
     @detail_route(methods=['put'])
     def shutdown(self, request, computeset_id, format=None):
         """Shutdown the nodes in the identified ComputeSet."""
         cset = ComputeSet.objects.get(pk=computeset_id)
-        if not cset.cluster.project in request.user.groups.all():
+        if not cset.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
 
         computes = []
@@ -381,7 +507,7 @@ class ComputeSetViewSet(ModelViewSet):
     def reboot(self, request, computeset_id, format=None):
         """Reboot the nodes in the identified ComputeSet."""
         cset = ComputeSet.objects.get(pk=computeset_id)
-        if not cset.cluster.project in request.user.groups.all():
+        if not cset.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
 
         computes = []
@@ -396,7 +522,7 @@ class ComputeSetViewSet(ModelViewSet):
     def reset(self, request, computeset_id, format=None):
         """Reset the nodes in the identified ComputeSet."""
         cset = ComputeSet.objects.get(pk=computeset_id)
-        if not cset.cluster.project in request.user.groups.all():
+        if not cset.cluster.project_id in project_ids(request.user):
             raise PermissionDenied()
 
         computes = []
@@ -407,6 +533,17 @@ class ComputeSetViewSet(ModelViewSet):
 
         return Response(status=204)
 
+
+def allocation_conflicts(computes):
+    """Return a 400 response naming every allocated compute, or None."""
+    conflicts = ComputeAllocation.objects.filter(compute__in=computes).values_list(
+        'compute__name', 'computeset__id', 'computeset__state')
+    if not conflicts:
+        return None
+    return Response("; ".join(
+        "The compute %s belongs to computeset %s which is in %s state" % conflict
+        for conflict in conflicts), status=status.HTTP_400_BAD_REQUEST)
+
 # #################################################
 #  FRONTEND
 # #################################################
@@ -417,7 +554,7 @@ class FrontendViewSet(ViewSet):
     def retrieve(self, request, frontend_cluster_name, format=None):
         """Obtain the details of a frontend resource in a named cluster."""
         clust = get_object_or_404(Cluster, name=frontend_cluster_name)
-        if not clust.project in request.user.groups.all():
+        if not clust.project_id in project_ids(request.user):
             raise PermissionDenied()
         serializer = FrontendSerializer(clust.frontend)
         return Response(serializer.data)
@@ -426,7 +563,7 @@ class FrontendViewSet(ViewSet):
     def shutdown(self, request, frontend_cluster_name, format=None):
         """Shutdown the frontend of a named cluster."""
         clust = get_object_or_404(Cluster, name=frontend_cluster_name)
-        if not clust.project in request.user.groups.all():
+        if not clust.project_id in project_ids(request.user):
             raise PermissionDenied()
         poweroff_nodes.delay([clust.frontend.rocks_name], "shutdown")
         return Response(status=204)
@@ -435,7 +572,7 @@ class FrontendViewSet(ViewSet):
     def reboot(self, request, frontend_cluster_name, format=None):
         """Reboot the frontend of a named cluster."""
         clust = get_object_or_404(Cluster, name=frontend_cluster_name)
-        if not clust.project in request.user.groups.all():
+        if not clust.project_id in project_ids(request.user):
             raise PermissionDenied()
         poweroff_nodes.delay([clust.frontend.rocks_name], "reboot")
         return Response(status=204)
@@ -449,7 +586,7 @@ class FrontendViewSet(ViewSet):
     def poweron(self, request, frontend_cluster_name, format=None):
         """Power on the frontend of a named cluster."""
         clust = get_object_or_404(Cluster, name=frontend_cluster_name)
-        if not clust.project in request.user.groups.all():
+        if not clust.project_id in project_ids(request.user):
             raise PermissionDenied()
         poweron_nodes.delay([clust.frontend.rocks_name])
         return Response(status=204)
@@ -458,7 +595,7 @@ class FrontendViewSet(ViewSet):
     def poweroff(self, request, frontend_cluster_name, format=None):
         """Power off the frontend of a named cluster."""
         clust = get_object_or_404(Cluster, name=frontend_cluster_name)
-        if not clust.project in request.user.groups.all():
+        if not clust.project_id in project_ids(request.user):
             raise PermissionDenied()
         poweroff_nodes.delay([clust.frontend.rocks_name], "poweroff")
         return Response(status=204)
@@ -468,7 +605,7 @@ class FrontendViewSet(ViewSet):
         """Attach an ISO to the frontendresource in a named cluster.
         """
         clust = get_object_or_404(Cluster, name=frontend_cluster_name)
-        if not clust.project in request.user.groups.all():
+        if not clust.project_id in project_ids(request.user):
             raise PermissionDenied()
         poweron_nodes.delay([clust.frontend.rocks_name])
         if not "iso_name" in request.GET:
@@ -477,6 +614,185 @@ class FrontendViewSet(ViewSet):
         return Response(status=204)
 
 
+# #################################################
+#  EVENT
+# #################################################
+
+
+class StateEventView(APIView):
+
+    """
+    Long-polls for computeset and compute state changes.
+
+    Accepts the following GET parameters:
+        Optional: since (sequence number of the last event seen),
+                  computeset (only return events of this ComputeSet),
+                  timeout (seconds to wait for an event)
+    Returns the events committed after since together with the sequence
+    number to pass as since on the next call. Without since, waits for
+    events committed after the call. Events are kept for
+    settings.STATE_EVENT_RETENTION seconds.
+
+    Each waiting client holds a server worker, so at most MAX_WAITERS
+    requests of a process wait at a time; the others return at once with
+    the events already committed.
+    """
+    POLL_INTERVAL = 2.0
+    DEFAULT_TIMEOUT = 10
+    MAX_TIMEOUT = 20
+    MAX_EVENTS = 500
+    MAX_WAITERS = 4
+    waiters = 0
+    waiters_lock = threading.Lock()
+    # A sequence gap younger than this may still be filled by a transaction
+    # that has not committed yet, so events past it are held back.
+    SETTLE_TIME = 5
+
+    def get(self, request, format=None):
+        events = StateEvent.objects.filter(
+            cluster__project__in=project_ids(request.user)).select_related(
+            'cluster').order_by('id')
+        computeset = request.query_params.get('computeset')
+        since = request.query_params.get(
+            'since', request.META.get('HTTP_LAST_EVENT_ID'))
+        try:
+            if computeset:
+                events = events.filter(
+                    kind=StateEvent.EVENT_KIND_COMPUTESET,
+                    object_id=int(computeset))
+            if since is None:
+                since = StateEvent.objects.aggregate(Max('id'))['id__max'] or 0
+            since = int(since)
+            timeout = min(float(request.query_params.get(
+                'timeout', self.DEFAULT_TIMEOUT)), self.MAX_TIMEOUT)
+        except ValueError:
+            return Response("computeset, since and timeout should be numbers",
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        with StateEventView.waiters_lock:
+            waiting = StateEventView.waiters < self.MAX_WAITERS
+            if waiting:
+                StateEventView.waiters += 1
+        if not waiting:
+            timeout = 0
+
+        try:
+            deadline = time.time() + timeout
+            while True:
+                upto = self.committed_upto(since)
+                batch = list(events.filter(id__gt=since, id__lte=upto))
+                since = upto
+                if batch or time.time() >= deadline:
+                    break
+                time.sleep(self.POLL_INTERVAL)
+        finally:
+            if waiting:
+                with StateEventView.waiters_lock:
+                    StateEventView.waiters -= 1
+
+        serializer = StateEventSerializer(batch, many=True)
+        return Response({'since': since, 'events': serializer.data})
+
+    def committed_upto(self, since):
+        """Return the last sequence number that is safe to deliver."""
+        settled = timezone.now() - datetime.timedelta(seconds=self.SETTLE_TIME)
+        upto = since
+        for seq, created in StateEvent.objects.filter(id__gt=since).order_by(
+                'id').values_list('id', 'created')[:self.MAX_EVENTS]:
+            if seq != upto + 1 and created > settled:
+                break
+            upto = seq
+        return upto
+
+
+# #################################################
+#  METRICS
+# #################################################
+
+
+class TransitionMetricsView(APIView):
+
+    """
+    Returns ComputeSet state transition latencies in JSON format.
+
+    Accepts the following GET parameters:
+        Optional: since, until (ISO 8601 timestamps, default the last day),
+                  cluster (only report the named cluster)
+    Returns, per cluster and transition, the number of transitions and the
+    50th, 95th and 99th percentile of the seconds spent in the old state.
+
+    The time spent in the old state is the time since the previous state
+    event of the ComputeSet, so transitions whose previous event was
+    purged are not counted.
+    """
+    DEFAULT_WINDOW = datetime.timedelta(days=1)
+    PERCENTILES = (50, 95, 99)
+
+    def get(self, request, format=None):
+        try:
+            until = parse_timestamp(request.query_params.get('until'))
+            since = parse_timestamp(request.query_params.get('since'))
+        except ValueError:
+            return Response("since and until should be ISO 8601 timestamps",
+                            status=status.HTTP_400_BAD_REQUEST)
+        if until is None:
+            until = timezone.now()
+        if since is None:
+            since = until - self.DEFAULT_WINDOW
+
+        events = StateEvent.objects.filter(
+            kind=StateEvent.EVENT_KIND_COMPUTESET,
+            cluster__project__in=project_ids(request.user), created__lt=until)
+        cluster = request.query_params.get('cluster')
+        if cluster:
+            events = events.filter(cluster__name=cluster)
+
+        # All the events of the ComputeSets that changed state in the
+        # window, to find the one before each transition
+        computesets = events.filter(created__gte=since).values('object_id')
+        durations = {}
+        previous = (None, None)
+        for object_id, cluster, created, old_state, state in events.filter(
+                object_id__in=computesets).order_by(
+                'object_id', 'id').values_list(
+                'object_id', 'cluster__name', 'created', 'old_state', 'state'):
+            if (created >= since and old_state is not None and
+                    previous[0] == object_id):
+                duration = (created - previous[1]).total_seconds()
+                durations.setdefault(
+                    (cluster, old_state, state), []).append(duration)
+            previous = (object_id, created)
+
+        metrics = []
+        for (cluster, old_state, state), values in sorted(durations.items()):
+            values.sort()
+            metric = {'cluster': cluster, 'old_state': old_state,
+                      'state': state, 'count': len(values)}
+            for pct in self.PERCENTILES:
+                metric['p%d' % pct] = percentile(values, pct)
+            metrics.append(metric)
+
+        return Response({'since': since, 'until': until, 'transitions': metrics})
+
+
+def parse_timestamp(value):
+    """Parse an optional ISO 8601 timestamp, assuming UTC if naive."""
+    if not value:
+        return None
+    timestamp = parse_datetime(value)
+    if timestamp is None:
+        raise ValueError("bad timestamp %s" % value)
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp, timezone.utc)
+    return timestamp
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted, non-empty list."""
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
 # #################################################
 #  USER
 # #################################################
@@ -92,6 +92,40 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.8/topics/cache/
+#
+# Idempotency keys and the versions of the cached authentication data live
+# here. Use a shared backend (e.g. memcached) when the API runs in several
+# processes so that a retry reaching another process is still recognized,
+# and a user or API key change is seen at once by all of them.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Seconds an Idempotency-Key of a ComputeSet creation is remembered
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+# Seconds an Idempotency-Key is reported as in progress, about the longest
+# a request may run, so a retry succeeds if the first request died
+IDEMPOTENCY_PENDING_TTL = 60
+
+# Where the nonces of the signed API requests are remembered to detect
+# replays: api.nonces.DatabaseNonceStore, CacheNonceStore (needs a shared
+# cache with several API processes) or MemoryNonceStore (a single process).
+# The database is purged by the periodic api.tasks.purge_nonces task.
+NONCE_STORE = 'api.nonces.DatabaseNonceStore'
+
+# Seconds the API keys, the project memberships of the users and the
+# verified basic auth credentials are cached by each API process. Without
+# a shared cache above, changes made through another process take up to
+# this long to be seen.
+AUTH_CACHE_TTL = 60
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -114,7 +148,7 @@ STATIC_ROOT = '/var/www/html/static'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.BasicAuthentication',
+        'api.auth.NucleusBasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.TokenAuthentication',
         'api.auth.NucleusAPISignatureAuthentication'
@@ -124,13 +158,25 @@ REST_FRAMEWORK = {
     )
 }
 
+# Seconds the compute state events are kept for the event stream clients to
+# resume. The computeset events are kept for the transition metrics.
+STATE_EVENT_RETENTION = 7 * 24 * 60 * 60
+
+# Number of update.<n> queues the update tasks are partitioned across,
+# each one consumed by a single worker process (see the Makefile)
+UPDATE_QUEUE_PARTITIONS = 4
+
 CELERY_ROUTES = (
+    'api.routing.UpdatePartitionRouter',
     {'api.tasks.submit_computeset':
      {'routing_key': 'comet-fe1'}
      },
     {'api.tasks.cancel_computeset':
      {'routing_key': 'comet-fe1'}
      },
+    {'api.tasks.cancel_computesets':
+     {'routing_key': 'comet-fe1'}
+     },
     {'api.tasks.poweron_nodeset':
      {'routing_key': 'comet-fe1'}
      },
@@ -143,22 +189,39 @@ CELERY_ROUTES = (
     {'api.tasks.attach_iso':
      {'routing_key': 'comet-fe1'}
      },
-    {'api.tasks.update_computeset':
+    {'api.tasks.purge_state_events':
      {'routing_key': 'update'}
      },
-    {'api.tasks.update_clusters':
+    {'api.tasks.purge_nonces':
      {'routing_key': 'update'}
      }
 )
 
+# Periodic tasks, sent by the beat of the workers started with -B
+CELERYBEAT_SCHEDULE = {
+    'purge-state-events': {
+        'task': 'api.tasks.purge_state_events',
+        'schedule': 60 * 60,
+    },
+    'purge-nonces': {
+        'task': 'api.tasks.purge_nonces',
+        'schedule': 5 * 60,
+    },
+}
+
 CELERY_QUEUES = {
     'comet-fe1': {
         'binding_key': 'comet-fe1',
     },
+    # Drained by the worker of partition 0
     'update': {
         'binding_key': 'update',
     },
 }
+for partition in range(UPDATE_QUEUE_PARTITIONS):
+    CELERY_QUEUES['update.%d' % partition] = {
+        'binding_key': 'update.%d' % partition,
+    }
 
 
 SWAGGER_SETTINGS = {
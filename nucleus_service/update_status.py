@@ -1,52 +1,201 @@
 #!/usr/bin/python
+""" Collect the status of the rocks clusters and send it to update_clusters().
 
+    The rocks queries of each cluster run in a bounded pool of worker
+    threads and every rocks command runs under a timeout, so a sweep takes
+    about as long as the slowest cluster and a hung rocks call only fails
+    the cluster it belongs to. Failed clusters are reported and left out
+    of the update.
+
+    The JSON output of rocks is parsed one record at a time as it is read
+    and the records are joined to the computes by name, so a cluster is
+    collected in linear time without holding the raw output in memory.
+
+    Only the clusters whose status changed since the last published sweep
+    are sent. The content hash of every published cluster is kept in
+    STATE_FILE, and all the clusters are sent again every FULL_SYNC_INTERVAL
+    seconds to catch anything that drifted in the database. The clusters
+    update_clusters() failed to sync are reported back on the
+    SYNC_FAILURES_QUEUE and sent again by the next sweep.
+
+    Run with --daemon to stay resident and sweep every --interval seconds,
+    give or take --jitter. The daemon keeps its state in memory and reuses
+    the broker connection of the celery producer pool between sweeps. The
+    timings of the last sweeps are logged to syslog and written to
+    STATS_FILE. The clusters that failed to collect are logged to syslog
+    with their error.
+"""
+
+import argparse
+from collections import deque
+import hashlib
 import json
+import os
+import random
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE
+import sys
+import syslog
+import tempfile
+import time
 import traceback
 
 from nucleus.celery import *
 
-from api.tasks import update_clusters
+from api.tasks import update_clusters, SYNC_FAILURES_QUEUE
 
-clusters_req = Popen(['/opt/rocks/bin/rocks', 'list', 'cluster',
-                      'json=true', 'status=true'], stdout=PIPE, stderr=PIPE)
-(out, err) = clusters_req.communicate()
+ROCKS = '/opt/rocks/bin/rocks'
 
-clusters = json.loads(out)
+# Seconds a rocks command may run before it is killed
+ROCKS_TIMEOUT = 120
 
-result = []
+# Number of clusters collected concurrently
+WORKERS = 8
 
-for record in clusters:
-    if record['frontend']:
-        res_clust = {
-            'frontend': record['frontend'],
-            'interfaces': [],
-            'mem': 0,
-            'cpus': 0,
-            'state': record['cluster'][0]['status'],
-            'type': record['cluster'][0]['type'],
-            'computes': []
-        }
-    else:
-        res_clust['computes'] = [
-            {
-                'name': client['client nodes'],
+# Hashes of the clusters last published
+STATE_FILE = '/var/tmp/nucleus_update_status.json'
+
+# Seconds between publishing all the clusters, changed or not
+FULL_SYNC_INTERVAL = 60 * 60
+
+# Timings of the last sweeps of the daemon
+STATS_FILE = '/var/tmp/nucleus_update_status.stats'
+
+# Number of sweeps the timings are kept for
+STATS_SWEEPS = 100
+
+# Bytes of rocks output read at a time
+READ_SIZE = 64 * 1024
+
+WHITESPACE = ' \t\n\r'
+
+
+class RocksError(Exception):
+    pass
+
+
+def iter_json_array(stream, read_size=READ_SIZE):
+    """ Yield the elements of the JSON array read from stream one at a time.
+        Only the element being decoded is kept in the buffer.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        while pos < len(buf) and buf[pos] in WHITESPACE:
+            pos += 1
+
+        if pos < len(buf):
+            char = buf[pos]
+            if not started:
+                if char != '[':
+                    raise RocksError("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            elif char == ']':
+                return
+            elif char == ',':
+                pos += 1
+                continue
+
+            # An element is complete once the separator after it is read,
+            # a number at the end of the buffer may be cut short
+            try:
+                (value, end) = decoder.raw_decode(buf, pos)
+                after = end
+                while after < len(buf) and buf[after] in WHITESPACE:
+                    after += 1
+            except ValueError:
+                after = len(buf)
+            if after < len(buf) and buf[after] in ',]':
+                pos = end
+                yield value
+                continue
+            elif after < len(buf) and eof:
+                raise RocksError("Invalid JSON output")
+
+        if eof:
+            if started:
+                raise RocksError("Truncated JSON output")
+            return
+
+        # Read at least as much as is buffered, so an element spanning
+        # many reads is decoded a logarithmic number of times
+        chunk = stream.read(max(read_size, len(buf) - pos))
+        buf = buf[pos:] + chunk
+        pos = 0
+        eof = not chunk
+
+
+def rocks_list(*args):
+    """Run 'rocks list ... json=true' and yield the records of its output."""
+    cmd = ['/usr/bin/timeout', str(ROCKS_TIMEOUT), ROCKS, 'list']
+    cmd.extend(args)
+    cmd.append('json=true')
+    err = tempfile.TemporaryFile()
+    req = Popen(cmd, stdout=PIPE, stderr=err)
+    try:
+        for record in iter_json_array(req.stdout):
+            yield record
+        req.stdout.read()
+        req.wait()
+    except RocksError:
+        # A killed or failing rocks leaves truncated output behind
+        req.wait()
+        if not req.returncode:
+            raise
+    finally:
+        if req.returncode is None:
+            req.kill()
+            req.wait()
+        req.stdout.close()
+
+    if req.returncode == 124:
+        raise RocksError("Timeout after %ss: %s" % (ROCKS_TIMEOUT, ' '.join(cmd)))
+    elif req.returncode:
+        err.seek(0)
+        raise RocksError("%s: %s" % (' '.join(cmd), err.read().strip()))
+
+
+def list_clusters():
+    """Return the clusters known to rocks with their computes."""
+    result = []
+    for record in rocks_list('cluster', 'status=true'):
+        if record['frontend']:
+            res_clust = {
+                'frontend': record['frontend'],
                 'interfaces': [],
                 'mem': 0,
                 'cpus': 0,
-                'type': client['type'],
-                'state': client['status']
-            } for client in record["cluster"]
-        ]
-        result.append(res_clust)
+                'state': record['cluster'][0]['status'],
+                'type': record['cluster'][0]['type'],
+                'computes': []
+            }
+        else:
+            res_clust['computes'] = [
+                {
+                    'name': client['client nodes'],
+                    'interfaces': [],
+                    'mem': 0,
+                    'cpus': 0,
+                    'type': client['type'],
+                    'state': client['status']
+                } for client in record["cluster"]
+            ]
+            result.append(res_clust)
+    return result
+
 
-for cluster in result:
+def collect_cluster(cluster):
+    """ Fill in the interfaces, memory and cpus of a cluster and its computes.
+        Returns the cluster and None, or the cluster and the error.
+    """
     try:
-        fe_req = Popen(['/opt/rocks/bin/rocks', 'list', 'host', 'interface',
-                        cluster['frontend'], 'json=true'], stdout=PIPE, stderr=PIPE)
-        (out, err) = fe_req.communicate()
-        if out:
-            for if_rec in json.loads(out)[0]['interface']:
+        for rec in rocks_list('host', 'interface', cluster['frontend']):
+            for if_rec in rec['interface']:
                 interface = {
                     'ip': if_rec['ip'],
                     'mac': if_rec['mac'],
@@ -58,48 +207,223 @@ for cluster in result:
                 if(if_rec['subnet'] == 'private'):
                     cluster['vlan'] = if_rec['vlan']
 
-        vm_req = Popen(['/opt/rocks/bin/rocks', 'list', 'host', 'vm',
-                        cluster['frontend'], 'json=true'], stdout=PIPE, stderr=PIPE)
-        (out, err) = vm_req.communicate()
-        if out:
-            for vm_rec in json.loads(out)[0]["vm"]:
+        for rec in rocks_list('host', 'vm', cluster['frontend']):
+            for vm_rec in rec["vm"]:
                 if(vm_rec["mem"]):
                     cluster["mem"] = vm_rec["mem"]
                     cluster["cpus"] = vm_rec["cpus"]
 
-        args = ['/opt/rocks/bin/rocks', 'list', 'host', 'interface']
-        args.extend([compute['name'] for compute in cluster['computes']])
-        args.append('json=true')
-        fe_req = Popen(args, stdout=PIPE, stderr=PIPE)
-        (out, err) = fe_req.communicate()
-        if out:
-            for rec in json.loads(out):
-                for if_rec in rec['interface']:
-                    interface = {
-                        'ip': if_rec['ip'],
-                        'mac': if_rec['mac'],
-                        'iface': if_rec['iface'],
-                        'netmask': if_rec['netmask'],
-                        'subnet': if_rec['subnet'],
-                    }
-                    next(compute for compute in cluster['computes'] if compute[
-                         'name'] == rec['host'])['interfaces'].append(interface)
-
-        args = ['/opt/rocks/bin/rocks', 'list', 'host', 'vm']
-        args.extend([compute['name'] for compute in cluster['computes']])
-        args.append('json=true')
-        vm_req = Popen(args, stdout=PIPE, stderr=PIPE)
-        (out, err) = vm_req.communicate()
-        if out:
-            for vm_rec in json.loads(out):
-                compute = next(compute for compute in cluster['computes'] if compute[
-                     'name'] == vm_rec['vm-host'])
-                compute["mem"] = vm_rec["vm"][0]["mem"]
-                compute["cpus"] = vm_rec["vm"][0]["cpus"]
+        computes = dict((compute['name'], compute)
+                        for compute in cluster['computes'])
+        if not computes:
+            return (cluster, None)
+
+        for rec in rocks_list('host', 'interface', *computes):
+            compute = computes[rec['host']]
+            for if_rec in rec['interface']:
+                interface = {
+                    'ip': if_rec['ip'],
+                    'mac': if_rec['mac'],
+                    'iface': if_rec['iface'],
+                    'netmask': if_rec['netmask'],
+                    'subnet': if_rec['subnet'],
+                }
+                compute['interfaces'].append(interface)
+
+        for vm_rec in rocks_list('host', 'vm', *computes):
+            compute = computes[vm_rec['vm-host']]
+            compute["mem"] = vm_rec["vm"][0]["mem"]
+            compute["cpus"] = vm_rec["vm"][0]["cpus"]
 
     except:
-        # print "Unexpected error:", traceback.print_tb(sys.exc_info()[2])
-        traceback.print_exc()
+        return (cluster, traceback.format_exc())
+
+    return (cluster, None)
+
+
+def sweep():
+    """ Collect all the clusters in parallel.
+        Returns the collected clusters and a {frontend: error} dict.
+    """
+    clusters = list_clusters()
+    pool = ThreadPool(max(min(WORKERS, len(clusters)), 1))
+    try:
+        collected = pool.map(collect_cluster, clusters)
+    finally:
+        pool.close()
+        pool.join()
+
+    result = [cluster for (cluster, error) in collected if error is None]
+    errors = dict((cluster['frontend'], error)
+                  for (cluster, error) in collected if error is not None)
+    return (result, errors)
+
+
+def cluster_hash(cluster):
+    """Return a hash of the content of a collected cluster."""
+    return hashlib.sha1(json.dumps(cluster, sort_keys=True)).hexdigest()
+
+
+def load_state():
+    """Return the state saved by the last published sweep."""
+    try:
+        with open(STATE_FILE) as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return {'full_sync': 0, 'hashes': {}}
+
+
+def save_state(state, path=None):
+    """Atomically replace the saved state."""
+    path = path or STATE_FILE
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as state_file:
+        json.dump(state, state_file)
+    os.rename(tmp_file, path)
+
+
+def sync_failures():
+    """Return the frontends update_clusters() reported it failed to sync."""
+    frontends = set()
+    with app.connection() as connection:
+        queue = connection.SimpleQueue(SYNC_FAILURES_QUEUE)
+        try:
+            while True:
+                try:
+                    message = queue.get_nowait()
+                except queue.Empty:
+                    break
+                frontends.update(message.payload['frontends'])
+                message.ack()
+        finally:
+            queue.close()
+    return frontends
+
+
+def changed_clusters(result, errors, state, now, failed=()):
+    """ Return the clusters to publish and the state to save once they are.
+        All the clusters are returned when a full sync is due, and the
+        failed ones in any case.
+    """
+    hashes = dict((cluster['frontend'], cluster_hash(cluster))
+                  for cluster in result)
+    full_sync = now - state['full_sync'] >= FULL_SYNC_INTERVAL
+    if full_sync:
+        changed = result
+    else:
+        changed = [cluster for cluster in result
+                   if cluster['frontend'] in failed or
+                   state['hashes'].get(cluster['frontend']) !=
+                   hashes[cluster['frontend']]]
+
+    # Clusters that failed to collect keep their hash, so they are
+    # published when they come back only if they changed, unless their
+    # last sync failed too
+    for frontend in errors:
+        if frontend in failed:
+            hashes.pop(frontend, None)
+        elif frontend in state['hashes']:
+            hashes[frontend] = state['hashes'][frontend]
+
+    new_state = {
+        'full_sync': now if full_sync else state['full_sync'],
+        'hashes': hashes,
+    }
+    return (changed, new_state)
+
+
+def run_sweep(state):
+    """ Collect the clusters and publish the changed ones.
+        Returns the new state, the collection errors and the sweep timings.
+    """
+    start = time.time()
+    # Read before collecting, a sync failing meanwhile is read next time
+    failed = sync_failures()
+    (result, errors) = sweep()
+    collected = time.time()
+    for frontend, error in sorted(errors.items()):
+        # The daemon has no stderr, syslog is where its failures are seen
+        syslog.syslog(syslog.LOG_ERR, "update_status: failed to collect "
+                      "cluster %s: %s" % (frontend, error))
+        sys.stderr.write("Failed to collect cluster %s:\n%s\n" % (frontend, error))
+
+    # One message per cluster, so the update queue is partitioned by cluster
+    (changed, state) = changed_clusters(result, errors, state, start, failed)
+    for cluster in changed:
+        update_clusters.delay([cluster])
+        #print(json.dumps(cluster))
+    published = time.time()
+
+    timings = {
+        'start': start,
+        'collect': collected - start,
+        'publish': published - collected,
+        'total': published - start,
+        'clusters': len(result),
+        'changed': len(changed),
+        'errors': len(errors),
+    }
+    return (state, errors, timings)
+
+
+def report(sweeps):
+    """Log the last sweep and write the timings of the last sweeps."""
+    last = sweeps[-1]
+    syslog.syslog(
+        syslog.LOG_INFO,
+        "update_status sweep: %(total).2fs (collect %(collect).2fs, "
+        "publish %(publish).2fs), %(clusters)d clusters, %(changed)d changed, "
+        "%(errors)d errors" % last)
+
+    totals = sorted(timings['total'] for timings in sweeps)
+    stats = {
+        'last': last,
+        'sweeps': len(sweeps),
+        'min': totals[0],
+        'mean': sum(totals) / len(totals),
+        'max': totals[-1],
+        'history': list(sweeps),
+    }
+    save_state(stats, STATS_FILE)
+
+
+def daemon(interval, jitter):
+    """Sweep every interval +/- jitter seconds until killed."""
+    state = load_state()
+    sweeps = deque(maxlen=STATS_SWEEPS)
+    while True:
+        start = time.time()
+        try:
+            (state, errors, timings) = run_sweep(state)
+            save_state(state)
+            sweeps.append(timings)
+            report(sweeps)
+        except:
+            # The state is only advanced by a published sweep, so a failed
+            # one is retried in full on the next round
+            syslog.syslog(syslog.LOG_ERR, "update_status sweep failed: %s"
+                          % traceback.format_exc())
+
+        delay = interval + random.uniform(-jitter, jitter)
+        time.sleep(max(start + delay - time.time(), 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Send the status of the rocks clusters to nucleus')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and sweep every INTERVAL seconds')
+    parser.add_argument('--interval', type=float, default=300,
+                        help='seconds between the start of two sweeps')
+    parser.add_argument('--jitter', type=float, default=30,
+                        help='seconds a sweep may start early or late')
+    args = parser.parse_args()
+
+    if args.daemon:
+        daemon(args.interval, args.jitter)
+
+    (state, errors, timings) = run_sweep(load_state())
+    save_state(state)
 
-update_clusters.delay(result)
-#print(json.dumps(result))
+    if errors:
+        sys.exit(1)